@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+"""
+Fingerprinted static files.  Run ./assets.py on deploy: it copies static/
+into static/dist/ with a content hash in every filename (style.css ->
+style.3f9a1c0b2e.css), points url()s in the CSS at the hashed names, writes
+.gz (and .br, if the brotli module is installed) next to the CSS and SVG
+files and records everything in static/dist/manifest.json.
+
+Templates keep using url_for('static', filename=...), which gives the hashed
+URL once the manifest exists and the plain /static/ one otherwise.  Hashed
+files never change, so they're served as immutable for a year.  (In front of
+nginx, serve /static/dist/ with gzip_static/brotli_static and the same
+Cache-Control.)
+"""
+import os
+import re
+import time
+import gzip
+import json
+import hashlib
+import mimetypes
+import posixpath
+
+from flask import request, send_file, safe_join, abort
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+app_dir = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = app_dir+"/static"
+DIST_DIR = STATIC_DIR+"/dist"
+MANIFEST_PATH = DIST_DIR+"/manifest.json"
+
+# dist/ is our output; js/ is webshim (see get_dependencies.sh), which loads
+# its own files by relative path and so has to keep their names.
+SKIP_DIRS = {"dist", "js"}
+SKIP_FILES = {"robots.txt"}
+COMPRESS_EXTENSIONS = {".css", ".svg", ".js"}
+
+ONE_YEAR = 365*24*60*60
+IMMUTABLE = "public, max-age={}, immutable".format(ONE_YEAR)
+
+css_url_re = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+def hashed_name(name, data):
+    root, ext = posixpath.splitext(name)
+    return "{}.{}{}".format(root, hashlib.sha1(data).hexdigest()[:10], ext)
+
+def rewrite_css(name, css, manifest):
+    """Points url()s in the stylesheet `name` at the hashed files."""
+    def replace(match):
+        quote, url = match.groups()
+        if url.startswith(("data:", "http:", "https:", "//")):
+            return match.group(0)
+        if url.startswith("/static/"):
+            target = url[len("/static/"):]
+        else:
+            target = posixpath.normpath(posixpath.join(posixpath.dirname(name), url))
+        if target not in manifest:
+            print("{}: {} not found, leaving as is".format(name, url))
+            return match.group(0)
+        return "url({0}/static/dist/{1}{0})".format(quote, manifest[target])
+    return css_url_re.sub(replace, css)
+
+def compress(path, data):
+    with open(path+".gz", "wb") as f:
+        f.write(gzip.compress(data, 9))
+    if brotli:
+        with open(path+".br", "wb") as f:
+            f.write(brotli.compress(data))
+
+def build():
+    names = []
+    for dirpath, dirnames, filenames in os.walk(STATIC_DIR):
+        if dirpath == STATIC_DIR:
+            dirnames[:] = [d for d in dirnames if d not in SKIP_DIRS]
+        for filename in filenames:
+            name = os.path.relpath(os.path.join(dirpath, filename), STATIC_DIR).replace(os.sep, "/")
+            if name not in SKIP_FILES:
+                names.append(name)
+    # stylesheets last, so that what they refer to is already hashed
+    names.sort(key=lambda name: (name.endswith(".css"), name))
+
+    manifest = {}
+    for name in names:
+        data = open(os.path.join(STATIC_DIR, name), "rb").read()
+        if name.endswith(".css"):
+            data = rewrite_css(name, data.decode('utf-8'), manifest).encode('utf-8')
+        manifest[name] = hashed_name(name, data)
+        path = os.path.join(DIST_DIR, manifest[name])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        if posixpath.splitext(name)[1] in COMPRESS_EXTENSIONS:
+            compress(path, data)
+
+    with open(MANIFEST_PATH, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    return manifest
+
+def load_manifest():
+    try:
+        return json.load(open(MANIFEST_PATH))
+    except (EnvironmentError, ValueError):
+        return {}
+
+def send_dist(filename):
+    path = safe_join(DIST_DIR, filename)
+    if not os.path.isfile(path): abort(404)
+    mimetype = mimetypes.guess_type(path)[0]
+    for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if encoding in request.accept_encodings and os.path.exists(path+suffix):
+            response = send_file(path+suffix, mimetype=mimetype, conditional=True)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_file(path, mimetype=mimetype, conditional=True)
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.expires = time.time() + ONE_YEAR
+    return response
+
+def init_app(app):
+    """Makes url_for('static', ...) point into dist/ and serves it."""
+    manifest = load_manifest()
+
+    @app.url_defaults
+    def hashed_static(endpoint, values):
+        if endpoint == 'static' and values.get('filename') in manifest:
+            values['filename'] = "dist/"+manifest[values['filename']]
+
+    app.add_url_rule(app.static_url_path+"/dist/<path:filename>", 'static_dist', send_dist)
+
+if __name__ == "__main__":
+    manifest = build()
+    print("{} files in {}{}".format(len(manifest), DIST_DIR, "" if brotli else " (no brotli module, gzip only)"))
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+"""
+Times wikitransform against the BeautifulSoup transform it replaced, over the
+pages in test_data/wikipages (and cache/, if there is one).
+
+    python bench_wikitransform.py [rounds]
+"""
+import os
+import sys
+import time
+
+from bs4 import BeautifulSoup
+
+import wikitransform
+
+app_dir = os.path.dirname(os.path.abspath(__file__))
+
+def transform_wikipage_bs(page):
+    # The old implementation from rhweb2.py, for comparison.
+    page = page.replace("~CLEAR~", '<div style="clear: both;"></div>')
+    page = page.replace("retroherna.cz", "retroherna.org")
+    page = BeautifulSoup(page, "lxml")
+    for a in page.find_all('a'):
+        if a.get('href') and "/wiki/doku.php" in a['href']:
+            a['href'] = a['href'].replace("/wiki/doku.php?id=web:", "/").replace(':', '/')
+    
+    for img in page.find_all('img'):
+        if not img['src'].startswith("http"):
+            img['src'] = img['src'].replace("/wiki/lib/exe/fetch.php", "https://retroherna.org/wiki/lib/exe/fetch.php")
+        title = img.get('title')
+        
+        parent = img.parent
+        if parent.name == "a" and parent['href'].startswith("/wiki"):
+            parent.name = "div"
+            del parent['href']
+        else:
+            parent = page.new_tag("div")
+            img.wrap(parent)
+        classes = img.get('class')
+        parent['class'] = classes + [" mediawrap"]
+        if 'mediacenter' in classes and img.get('width'):
+            parent['style'] = 'width: {}px;'.format(img['width'])
+        del img['class']
+        
+        if title and not any(title.endswith(t) for t in ("png", "jpg", "jpeg", "gif")):
+            title = page.new_tag("div")
+            title['class'] = "mediatitle"
+            if img.get('width'):
+                title['style'] = "max-width: {}px;".format(img['width'])
+            title.string = img['title']
+            parent.append(title)
+    
+    page = page.html.body
+    page.name = "section"
+    return page
+
+def load_pages():
+    pages = []
+    for directory in (app_dir+"/test_data/wikipages", app_dir+"/cache"):
+        if not os.path.isdir(directory): continue
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".html"):
+                pages.append(open(os.path.join(directory, name), encoding="utf-8").read())
+    return pages
+
+def bench(label, transform, pages, rounds):
+    start = time.perf_counter()
+    for i in range(rounds):
+        for page in pages:
+            transform(page)
+    elapsed = time.perf_counter() - start
+    per_page = elapsed / (rounds * len(pages)) * 1000
+    print("{:>14}: {:.3f} ms per page".format(label, per_page))
+    return per_page
+
+if __name__ == "__main__":
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    pages = load_pages()
+    print("{} pages, {} rounds".format(len(pages), rounds))
+    old = bench("BeautifulSoup", lambda page: str(transform_wikipage_bs(page)), pages, rounds)
+    new = bench("lxml", lambda page: wikitransform.to_html(wikitransform.transform_wikipage(page)), pages, rounds)
+    print("{:.1f}x faster".format(old / new))
@@ -0,0 +1,131 @@
+# encoding: utf-8
+
+import os
+import fcntl
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+class LRUCache(object):
+    """
+    A bounded, thread-safe mapping with per-entry expiry.
+    Expired entries aren't thrown away - lookup() still returns them, flagged
+    as stale, so the caller can keep serving them while it refreshes.
+    """
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        """Returns (value, stale), or None if the key isn't cached at all."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+        value, expires = entry
+        return value, expires is not None and expires < time.time()
+
+    def get(self, key, default=None):
+        entry = self.lookup(key)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def set(self, key, value, ttl=None, stamp=None):
+        """Stores value.  stamp is when the value was produced (defaults to now),
+        so e.g. a file read from disk can expire according to its mtime."""
+        ttl = self.ttl if ttl is None else ttl
+        expires = None
+        if ttl is not None:
+            expires = (time.time() if stamp is None else stamp) + ttl
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def touch(self, key, ttl=None):
+        """Marks an existing entry fresh again without changing its value."""
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None:
+            self.set(key, entry[0], ttl=ttl)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+@contextmanager
+def file_lock(path, timeout=30):
+    """
+    An exclusive lock shared between processes (e.g. gunicorn workers).
+    Yields whether the lock was acquired - after timeout seconds the caller
+    is let through anyway, so one hung holder can't block everybody forever.
+    """
+    f = open(path, "a")
+    try:
+        deadline = time.time() + timeout
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                locked = True
+                break
+            except (IOError, OSError):
+                if time.time() > deadline:
+                    locked = False
+                    break
+                time.sleep(0.05)
+        try:
+            yield locked
+        finally:
+            if locked:
+                fcntl.flock(f, fcntl.LOCK_UN)
+    finally:
+        f.close()
+
+def stamp(path):
+    """When bump() was last called on path, in ns (0 if never).  A cheap way
+    to tell all processes that something changed."""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+def bump(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    now = time.time_ns()
+    open(path, "a").close()
+    os.utime(path, ns=(now, now))
+
+def write_atomic(path, data):
+    """Writes to a temporary file and renames it over path, so readers see
+    either the old or the new contents, never a partial file."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
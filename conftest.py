@@ -1,4 +1,5 @@
 import pytest
+from datetime import datetime, timedelta
 #from rhweb2 import app
 
 @pytest.fixture
@@ -6,3 +7,90 @@ def app():
     from rhweb2 import app
     return app
 
+
+@pytest.fixture
+def query_budget(client):
+    """query_budget(url, budget) gets url and fails if that took more than
+    budget queries, or ran a statement over and over (an N+1)."""
+    import querystats
+    def check(url, budget):
+        with querystats.record() as stats:
+            response = client.get(url)
+        assert response.status_code == 200
+        assert stats.count <= budget and not stats.repeated(), stats.report()
+        return stats
+    return check
+
+
+class ForumDB(object):
+    """What forum_db made (as ids, since its sessions come and go), and more
+    of it on demand."""
+    def __init__(self, db):
+        import bcrypt
+        self.db = db
+        password = bcrypt.hashpw(b"test", bcrypt.gensalt(rounds=4)).decode()
+        users = db.Group(name="user")
+        admin = db.User(login="admin", fullname="Admin", pass_=password, groups=[db.Group(name="admin"), users])
+        user = db.User(login="uzivatel", fullname="Uživatel", pass_=password, groups=[users])
+        db.session.add_all([admin, user])
+        db.session.commit()
+        self.admin_id, self.user_id = admin.uid, user.uid
+        db.ensure_trash()
+        self.forum_id, self.forum_url = self.make_forum("pytest")
+        self.stamp = datetime(2018, 1, 1)
+    
+    def make_forum(self, identifier):
+        """Returns the new forum's id and url."""
+        db = self.db
+        forum = db.Forum(name=identifier.capitalize(), identifier=identifier, description="",
+            position=0, category=db.Category(name="Test", position=0))
+        db.session.add(forum)
+        db.session.commit()
+        forum_id = forum.id
+        db.session.close()
+        return forum_id, "/forum/{}-{}".format(forum_id, identifier)
+    
+    def make_thread(self, posts=5, forum_id=None, author_id=None, name="test thread"):
+        """A thread with posts a minute apart, its last one the newest post
+        anywhere.  Returns its url and its post ids, oldest first."""
+        db = self.db
+        forum = db.session.query(db.Forum).get(forum_id or self.forum_id)
+        author = db.session.query(db.User).get(author_id or self.admin_id)
+        thread = db.Thread(forum=forum, author=author, name=name, timestamp=self.stamp)
+        db.session.add(thread)
+        post_list = []
+        for i in range(posts):
+            self.stamp += timedelta(minutes=1)
+            post_list.append(db.Post(thread=thread, author=author, timestamp=self.stamp,
+                text="post {} of {}".format(i, name)))
+        thread.laststamp = self.stamp
+        db.session.add_all(post_list)
+        db.session.commit()
+        url = "/forum/{}-{}/{}-{}".format(forum.id, forum.identifier, thread.id, db.url_friendly(name))
+        post_ids = [post.id for post in post_list]
+        db.recompute_counts()
+        db.session.close()
+        return url, post_ids
+
+@pytest.fixture
+def forum_db(app, tmp_path, monkeypatch):
+    """Points db at a throwaway sqlite database with an admin and a user
+    (both with password "test"), a forum and its trash, so that tests can
+    make and change rows of their own.  Returns a ForumDB."""
+    import db, querystats, rhforum
+    from sqlalchemy import create_engine
+    engine = create_engine("sqlite:///{}/rh.db".format(tmp_path))
+    querystats.listen(engine)
+    db.Base.metadata.create_all(bind=engine)
+    db.session.remove()
+    monkeypatch.setattr(db, "engine", engine)
+    # the process-wide caches know the other database's rows
+    monkeypatch.setattr(db, "group_ids", {})
+    monkeypatch.setattr(db, "group_ids_version", None)
+    rhforum.guest_cache.clear()
+    rhforum.post_html_cache.clear()
+    yield ForumDB(db)
+    db.session.remove()
+    engine.dispose()
+    rhforum.guest_cache.clear()
+    rhforum.post_html_cache.clear()
@@ -1,13 +1,15 @@
 # encoding: utf-8
 
 from datetime import datetime
+from collections import namedtuple
 
 from unidecode import unidecode
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, select, func, and_, or_, bindparam
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import scoped_session, sessionmaker, relationship, backref
-from sqlalchemy.schema import Column, ForeignKey, Table
+from sqlalchemy.orm import scoped_session, sessionmaker, relationship, backref, Session
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import Column, ForeignKey, Table, Index
 from sqlalchemy.types import DateTime, Integer, String, Enum, Text, Boolean, TypeDecorator
 
 from flask import Flask, url_for
@@ -15,6 +17,11 @@ from flask import Flask, url_for
 import bcrypt
 
 import os
+import sqlite3
+import threading
+
+from caching import stamp, bump
+import querystats
 app = Flask('rhforum')
 app_dir = os.path.dirname(os.path.abspath(__file__))
 app.config.from_pyfile(app_dir+"/config.py") # XXX
@@ -24,18 +31,63 @@ debug = app.config.get("DEBUG", False)
 def url_friendly(string):
     return unidecode(string).lower().replace(' ', '-').replace('/', '-')
 
-if 'mysql' in app.config['DB']:
-    engine = create_engine(app.config['DB'], encoding="utf8", pool_size = 100, pool_recycle=4200, echo=debug) # XXX
-    # pool_recycle is to prevent "server has gone away"
-else:
-    engine = create_engine(app.config['DB'], encoding="utf8", echo=debug)
+# Nothing here talks to the database on import; the engine gets made by
+# whoever needs it first.
+engine = None
+engine_lock = threading.Lock()
+
+def make_engine():
+    if 'mysql' in app.config['DB']:
+        return create_engine(app.config['DB'], encoding="utf8", pool_size = 100, pool_recycle=4200, echo=debug) # XXX
+        # pool_recycle is to prevent "server has gone away"
+    return create_engine(app.config['DB'], encoding="utf8", echo=debug)
+
+def get_engine():
+    global engine
+    if engine is None:
+        with engine_lock:
+            if engine is None:
+                engine = make_engine()
+                querystats.listen(engine)
+    return engine
 
-session = scoped_session(sessionmaker(bind=engine, autoflush=False))
+class LazySession(Session):
+    def get_bind(self, *args, **kwargs):
+        return get_engine()
 
-Base = declarative_base(bind=engine)
+session = scoped_session(sessionmaker(class_=LazySession, autoflush=False))
+
+Base = declarative_base()
 
 class OldHashingMethodException(Exception): pass
 
+Unread = namedtuple('Unread', "count post_id")
+
+# Group name -> gid, shared by the whole process.  Whoever changes groups
+# calls groups_changed(); everybody else picks it up at their next
+# refresh_groups() (once per request).
+GROUPS_STAMP = app_dir+"/cache/groups.stamp"
+group_ids = {}
+group_ids_version = None
+group_ids_lock = threading.Lock()
+
+def refresh_groups():
+    global group_ids, group_ids_version
+    version = stamp(GROUPS_STAMP)
+    if version == group_ids_version: return
+    with group_ids_lock:
+        if version != group_ids_version:
+            group_ids = {name: gid for gid, name in session.query(Group.gid, Group.name)}
+            group_ids_version = version
+
+def groups_changed():
+    bump(GROUPS_STAMP)
+    refresh_groups()
+
+def group_id(name):
+    if group_ids_version is None: refresh_groups()
+    return group_ids.get(name)
+
 class User(Base):
     __tablename__ = 'users'
     
@@ -51,6 +103,13 @@ class User(Base):
     laststamp = Column(DateTime)
     profile = Column(Text, default='')
     
+    post_count = Column(Integer, default=0, server_default='0', nullable=False)
+    
+    # Read tracking: everything up to read_watermark is read, then per forum
+    # everything up to ForumRead.timestamp, then per thread up to
+    # ThreadRead.last_post.  Marking things read bumps a watermark and drops
+    # the finer-grained rows it covers, so those stay few.
+    read_watermark = Column(DateTime)
     
     groups = relationship("Group", secondary='usergroup')
     
@@ -64,11 +123,14 @@ class User(Base):
     
     @property
     def num_posts(self):
-        return session.query(Post).filter(Post.author == self, Post.deleted==False).count()
+        return self.post_count or 0
+    
+    def refresh_counts(self):
+        self.post_count = session.query(Post).filter(Post.author == self, Post.deleted==False).count()
     
     @property
     def admin(self):
-        return session.query(Group).filter(Group.name=="admin").scalar() in self.groups
+        return self.in_group("admin")
     
     @property
     def url(self):
@@ -85,44 +147,86 @@ class User(Base):
         if not group.display: return ""
         return "{} {}".format(group.symbol or "", group.title or "").strip()
     
-    def num_unread(self, thread):
-        last_read = self.unread(thread)
-        if not last_read: return 0
-        return session.query(Post).filter(Post.thread == thread, Post.deleted == False, Post.timestamp > last_read.timestamp).count()
+    def forum_watermark(self, forum_id):
+        """Timestamp up to which everything in the forum is read, or None:
+        the later of the user's watermark and the forum's."""
+        stamps = [self.read_watermark,
+            session.query(func.max(ForumRead.timestamp)).filter(ForumRead.user_id == self.id, ForumRead.forum_id == forum_id).scalar()]
+        stamps = [stamp for stamp in stamps if stamp]
+        return max(stamps) if stamps else None
+    
+    def last_read(self, thread):
+        """Timestamp up to which the user has read the thread, or None."""
+        if not self.id: return None
+        stamps = [self.forum_watermark(thread.forum_id),
+            session.query(func.max(Post.timestamp)).join(ThreadRead, ThreadRead.last_post_id == Post.id)
+                .filter(ThreadRead.user_id == self.id, ThreadRead.thread_id == thread.id).scalar()]
+        stamps = [stamp for stamp in stamps if stamp]
+        return max(stamps) if stamps else None
+    
+    def unread_threads(self, threads):
+        """Unread state of many threads at once, in a single query: {thread id:
+        Unread(number of unread posts, id of the first one)}, for the threads
+        which have any.  A post counts as unread if it's newer than all of the
+        user's watermark, the forum's and the last post they read in the thread."""
+        ids = [thread.id for thread in threads]
+        if not self.id or not ids: return {}
+        last_read = session.query(ThreadRead.thread_id, func.max(Post.timestamp).label('timestamp'))\
+            .join(Post, Post.id == ThreadRead.last_post_id)\
+            .filter(ThreadRead.user_id == self.id, ThreadRead.thread_id.in_(ids))\
+            .group_by(ThreadRead.thread_id).subquery()
+        forum_read = session.query(ForumRead.forum_id, func.max(ForumRead.timestamp).label('timestamp'))\
+            .filter(ForumRead.user_id == self.id).group_by(ForumRead.forum_id).subquery()
+        # Edits keep the original's timestamp, and their page has an anchor
+        # for the original's id too, so that's what we point to.
+        rows = session.query(Post.thread_id, func.count(Post.id), func.min(func.coalesce(Post.original_id, Post.id)))\
+            .join(Thread, Thread.id == Post.thread_id)\
+            .outerjoin(last_read, last_read.c.thread_id == Post.thread_id)\
+            .outerjoin(forum_read, forum_read.c.forum_id == Thread.forum_id)\
+            .filter(Post.thread_id.in_(ids), Post.deleted == False,
+                or_(last_read.c.timestamp == None, Post.timestamp > last_read.c.timestamp),
+                or_(forum_read.c.timestamp == None, Post.timestamp > forum_read.c.timestamp))\
+            .group_by(Post.thread_id)
+        if self.read_watermark:
+            rows = rows.filter(Post.timestamp > self.read_watermark)
+        return {thread_id: Unread(count, post_id) for thread_id, count, post_id in rows}
     
-    def unread(self, thread):
-        if not self.id: return False
-        thread_read = session.query(ThreadRead).filter(ThreadRead.user==self, ThreadRead.thread==thread).first() # XXX should be .scalar()
-        if not thread_read:
-            return thread
-        if thread_read.last_post.current == thread.last_post:
-            return False
-        return thread_read.last_post.current
-    
-    def unread_post(self, post):
-        if not self.id: return False
-        thread_read = session.query(ThreadRead).filter(ThreadRead.user==self, ThreadRead.thread==post.thread).scalar()
-        if not thread_read:
-            return post.thread
-        if thread_read.last_post.current.timestamp >= post.timestamp:
-            return False
-        return post
+    @property
+    def group_ids(self):
+        # once per instance, which for g.user means once per request
+        if getattr(self, '_group_ids', None) is None:
+            if not self.uid:
+                self._group_ids = frozenset()
+            elif 'groups' in self.__dict__:
+                self._group_ids = frozenset(group.gid for group in self.groups)
+            else:
+                self._group_ids = frozenset(gid for gid, in session.query(usergroup.c.gid).filter(usergroup.c.uid == self.uid))
+        return self._group_ids
     
     def in_group(self, group_name):
-        group = session.query(Group).filter(Group.name==group_name).scalar()
-        if not group: return False
-        return group in self.groups
+        return group_id(group_name) in self.group_ids
         
     def read(self, post):
         if not post: return
         if not self.id: return
+        watermark = self.forum_watermark(post.thread.forum_id)
+        if watermark and post.timestamp <= watermark:
+            return # nothing new to remember
         thread_read = session.query(ThreadRead).filter(ThreadRead.user==self, ThreadRead.thread==post.thread).first()
         if not thread_read:
             thread_read = ThreadRead(user=self, thread=post.thread, last_post_id=post.original.id if post.original else post.id)
         else:
+            # going back to an earlier page doesn't unread the later ones
+            read_stamp = session.query(Post.timestamp).filter(Post.id == thread_read.last_post_id).scalar()
+            if read_stamp and post.timestamp <= read_stamp:
+                return
             thread_read.last_post_id=post.id # XXX why no post?
         session.add(thread_read)
-        session.commit()
+        try:
+            session.commit()
+        except IntegrityError:
+            # another request of ours got to insert the row first; it'll do
+            session.rollback()
     
     def verify_password(self, password):
         pass_ = self.pass_
@@ -135,10 +239,22 @@ class User(Base):
             # Old hashing method
             raise OldHashingMethodException
     
-    def read_all(self):
-        # Kinda heavy, I suppose...
-        for thread in session.query(Thread):
-            self.read(thread.last_post) # XXX each does a commit..
+    def read_all(self, timestamp=None):
+        self.read_watermark = timestamp or datetime.utcnow()
+        session.query(ThreadRead).filter(ThreadRead.user_id == self.id).delete(synchronize_session=False)
+        session.query(ForumRead).filter(ForumRead.user_id == self.id).delete(synchronize_session=False)
+        session.commit()
+    
+    def read_forum(self, forum, timestamp=None):
+        forum_read = session.query(ForumRead).filter(ForumRead.user_id == self.id, ForumRead.forum_id == forum.id).first()
+        if not forum_read:
+            forum_read = ForumRead(user=self, forum=forum)
+            session.add(forum_read)
+        forum_read.timestamp = timestamp or datetime.utcnow()
+        session.query(ThreadRead).filter(ThreadRead.user_id == self.id,
+            ThreadRead.thread_id.in_(session.query(Thread.id).filter(Thread.forum_id == forum.id).subquery()))\
+            .delete(synchronize_session=False)
+        session.commit()
     
     def set_password(self, password):
         pass_ = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('ascii')
@@ -213,6 +329,12 @@ class Forum(Base):
     
     trash = Column(Boolean, nullable=False, default=False)
     
+    # Kept up to date by count_new_post() and refresh_counts(), see there.
+    thread_count = Column(Integer, default=0, server_default='0', nullable=False)
+    post_count = Column(Integer, default=0, server_default='0', nullable=False)
+    last_post_id = Column(Integer, ForeignKey('posts.id', use_alter=True, name='fk_fora_last_post_id'))
+    last_post = relationship("Post", foreign_keys=[last_post_id], post_update=True)
+    
     @property
     def url(self):
         if self.id:
@@ -220,9 +342,10 @@ class Forum(Base):
         else:
             return None
         
-    @property
-    def last_post(self):
-        return session.query(Post).join(Post.thread).filter(Thread.forum == self, Post.deleted==False).order_by(Post.timestamp.desc()).first()
+    def refresh_counts(self):
+        self.thread_count = session.query(Thread).filter(Thread.forum == self).count()
+        self.post_count = session.query(func.coalesce(func.sum(Thread.post_count), 0)).filter(Thread.forum == self).scalar()
+        self.last_post = session.query(Post).join(Post.thread).filter(Thread.forum == self, Post.deleted==False).order_by(Post.timestamp.desc(), Post.id.desc()).first()
     
     @property
     def symbol_name(self):
@@ -233,6 +356,9 @@ class Forum(Base):
 
 class Thread(Base):
     __tablename__ = 'threads'
+    # Indexes are created by the migrations in migrations/ (alembic upgrade
+    # head); these are here so that create_all() makes them too.
+    __table_args__ = (Index('ix_threads_forum_listing', 'forum_id', 'archived', 'pinned', 'laststamp'),)
     
     id = Column(Integer, primary_key=True, nullable=False)
     name = Column(String(255))
@@ -243,20 +369,24 @@ class Thread(Base):
     author = relationship("User", backref='threads')
     wiki_article = Column(String(255))
     timestamp = Column(DateTime)
-    laststamp = Column(DateTime)
+    laststamp = Column(DateTime, nullable=False)
     pinned = Column(Boolean, default=False, nullable=False)
     locked = Column(Boolean, default=False, nullable=False)
     archived = Column(Boolean, default=False, nullable=False)
     
-    posts = relationship("Post", order_by="Post.timestamp", lazy="dynamic")#, viewonly=True, primaryjoin="foreign(Post.deleted)==False")
+    posts = relationship("Post", order_by="Post.timestamp", lazy="dynamic", foreign_keys="Post.thread_id")#, viewonly=True, primaryjoin="foreign(Post.deleted)==False")
     
-    @property
-    def last_post(self):
-        return session.query(Post).filter(Post.thread == self, Post.deleted==False).order_by(Post.timestamp.desc()).first()
+    post_count = Column(Integer, default=0, server_default='0', nullable=False)
+    last_post_id = Column(Integer, ForeignKey('posts.id', use_alter=True, name='fk_threads_last_post_id'))
+    last_post = relationship("Post", foreign_keys=[last_post_id], post_update=True)
     
     @property
     def num_posts(self):
-        return session.query(Post).filter(Post.thread == self, Post.deleted==False).count()
+        return self.post_count or 0
+    
+    def refresh_counts(self):
+        self.post_count = session.query(Post).filter(Post.thread == self, Post.deleted==False).count()
+        self.last_post = session.query(Post).filter(Post.thread == self, Post.deleted==False).order_by(Post.timestamp.desc(), Post.id.desc()).first()
     
     @property
     def url(self):
@@ -267,15 +397,21 @@ class Thread(Base):
     @property
     def short_url(self):
         return url_for('.thread', forum_id=self.forum.id, thread_id=self.id)
+    
+    def post_url(self, post_id, short=False):
+        # ?post= gets the page the post is on
+        return (self.short_url if short else self.url) + "?post={0}#post-{0}".format(post_id)
 
 
 class Post(Base):
     __tablename__ = 'posts'
+    __table_args__ = (Index('ix_posts_thread_deleted_timestamp', 'thread_id', 'deleted', 'timestamp'),
+        Index('ix_posts_author_deleted', 'author_id', 'deleted'))
     
     id = Column(Integer, primary_key=True, nullable=False)
     name = Column(String(255))
     thread_id = Column(Integer, ForeignKey('threads.id'), nullable=False)
-    thread = relationship("Thread", order_by="Post.timestamp")
+    thread = relationship("Thread", order_by="Post.timestamp", foreign_keys=[thread_id])
     author_id = Column(Integer, ForeignKey('users.uid'), nullable=False)
     author = relationship("User", foreign_keys=[author_id], backref='posts')
     timestamp = Column(DateTime)
@@ -284,24 +420,29 @@ class Post(Base):
     deleted = Column(Boolean, default=False, nullable=False)
     editstamp = Column(DateTime)
     original_id = Column(Integer, ForeignKey('posts.id'))
-    original = relationship("Post", remote_side=id, backref="edits")
+    original = relationship("Post", remote_side=id, foreign_keys=[original_id], backref="edits")
+    # on an edited original, its newest revision
+    head_id = Column(Integer, ForeignKey('posts.id'))
+    head = relationship("Post", remote_side=id, foreign_keys=[head_id], post_update=True)
     editor_id = Column(Integer, ForeignKey('users.uid'))
     editor = relationship("User", foreign_keys=[editor_id])
     
     @property
     def url(self):
-        return self.thread.url + "#post-{}".format(self.id)
+        return self.thread.post_url(self.id)
     
     @property
     def short_url(self):
-        return self.thread.short_url + "#post-{}".format(self.id)
+        return self.thread.post_url(self.id, short=True)
     
     @property
     def current(self):
-        return session.query(Post).filter(Post.original == self).order_by(Post.editstamp.desc()).first() or self
+        original = self.original or self
+        return original.head or original
 
 class ThreadRead(Base):
     __tablename__ = 'threads_read'
+    __table_args__ = (Index('ix_threads_read_user_thread', 'user_id', 'thread_id', unique=True),)
     
     id = Column(Integer, primary_key=True, nullable=False)
     thread_id = Column(Integer, ForeignKey('threads.id'), nullable=False)
@@ -311,6 +452,16 @@ class ThreadRead(Base):
     last_post_id = Column(Integer, ForeignKey('posts.id'))
     last_post = relationship("Post")
 
+class ForumRead(Base):
+    __tablename__ = 'fora_read'
+    
+    id = Column(Integer, primary_key=True, nullable=False)
+    forum_id = Column(Integer, ForeignKey('fora.id'), nullable=False)
+    forum = relationship("Forum", backref=backref('reads', cascade="all, delete-orphan"))
+    user_id = Column(Integer, ForeignKey('users.uid'), nullable=False)
+    user = relationship("User", backref='fora_read')
+    timestamp = Column(DateTime)
+
 class Task(Base):
     __tablename__ = 'tasks'
     
@@ -331,18 +482,119 @@ class Task(Base):
     thread = relationship("Thread")
     
 
+class Outbox(Base):
+    """Messages waiting for outbox.py to send them, see rhforum.notify()."""
+    __tablename__ = 'outbox'
+    
+    id = Column(Integer, primary_key=True, nullable=False)
+    channel = Column(String(20), nullable=False)
+    message = Column(Text, nullable=False)
+    created = Column(DateTime)
+    attempts = Column(Integer, default=0, server_default='0', nullable=False)
+    next_attempt = Column(DateTime)
+
+def count_new_post(post, new_thread=False):
+    """Bumps the stored counts for a just added post.  Call before committing,
+    so that the counts go in the same transaction.  The increments happen in
+    SQL, so concurrent posts don't overwrite each other's."""
+    thread = post.thread
+    forum = thread.forum
+    session.flush()
+    for counted in (thread, forum, post.author):
+        counted.post_count = type(counted).post_count + 1
+    if new_thread:
+        forum.thread_count = Forum.thread_count + 1
+    thread.last_post = forum.last_post = post
+
+def refresh_counts(*counted):
+    """Recomputes the stored counts of the given threads, fora and users
+    after an edit, a deletion or a move.  Threads go before their fora,
+    as a forum's counts are summed from its threads'."""
+    for item in counted:
+        session.flush()
+        item.refresh_counts()
+
+def backfill_heads():
+    """Points every edited original post at its newest revision.  Migration
+    4b8e0f1c2d3a does the same when it adds posts.head_id; this is for
+    repairing it later."""
+    revision = Post.__table__.alias()
+    newest = select([revision.c.id]).where(revision.c.original_id == Post.id)\
+        .order_by(revision.c.editstamp.desc(), revision.c.id.desc()).limit(1).as_scalar()
+    session.execute(Post.__table__.update().values(head_id=newest))
+    session.commit()
+
+def window_functions():
+    """Whether the database does ROW_NUMBER() OVER (...)."""
+    engine = get_engine()
+    if engine.dialect.name == 'sqlite':
+        return sqlite3.sqlite_version_info >= (3, 25)
+    if engine.dialect.name == 'mysql':
+        # MariaDB reports e.g. (10, 2, 14, 'MariaDB')
+        version = engine.dialect.server_version_info or ()
+        return version >= ((10, 2) if 'MariaDB' in version else (8,))
+    return True
+
+def latest_posts(by):
+    """{thread or forum id: id of its newest live post} for all of them at
+    once.  by is Post.thread_id or Thread.forum_id."""
+    # select_from: with by = Thread.forum_id the query would start from
+    # threads and join it to itself
+    live = Post.deleted == False
+    if window_functions():
+        rank = func.row_number().over(partition_by=by, order_by=(Post.timestamp.desc(), Post.id.desc()))
+        ranked = session.query(by.label('key'), Post.id.label('post_id'), rank.label('rank'))\
+            .select_from(Post).join(Thread, Thread.id == Post.thread_id).filter(live).subquery()
+        rows = session.query(ranked.c.key, ranked.c.post_id).filter(ranked.c.rank == 1)
+    else:
+        # the newest timestamp of each, then the last post with it
+        newest = session.query(by.label('key'), func.max(Post.timestamp).label('timestamp'))\
+            .select_from(Post).join(Thread, Thread.id == Post.thread_id).filter(live).group_by(by).subquery()
+        rows = session.query(by, func.max(Post.id)).select_from(Post).join(Thread, Thread.id == Post.thread_id)\
+            .join(newest, and_(newest.c.key == by, newest.c.timestamp == Post.timestamp))\
+            .filter(live).group_by(by)
+    return dict(rows.all())
+
+def set_last_posts(table, latest):
+    session.execute(table.update().values(last_post_id=None))
+    if latest:
+        session.execute(table.update().where(table.c.id == bindparam('key')).values(last_post_id=bindparam('post_id')),
+            [{'key': key, 'post_id': post_id} for key, post_id in latest.items()])
+
+def recompute_counts():
+    """Recomputes all the stored counts from the posts, in case they drifted.
+    (Existing databases get them first from migration 4b8e0f1c2d3a, which
+    adds the columns; db.py's "recompute post counts?" prompt runs this.)"""
+    live = Post.deleted == False
+    
+    session.execute(Thread.__table__.update().values(
+        post_count=select([func.count(Post.id)]).where(and_(Post.thread_id == Thread.id, live)).as_scalar()))
+    set_last_posts(Thread.__table__, latest_posts(Post.thread_id))
+    
+    thread_alias = Thread.__table__.alias()
+    session.execute(Forum.__table__.update().values(
+        thread_count=select([func.count(thread_alias.c.id)]).where(thread_alias.c.forum_id == Forum.id).as_scalar(),
+        post_count=select([func.coalesce(func.sum(thread_alias.c.post_count), 0)]).where(thread_alias.c.forum_id == Forum.id).as_scalar()))
+    set_last_posts(Forum.__table__, latest_posts(Thread.forum_id))
+    
+    session.execute(User.__table__.update().values(
+        post_count=select([func.count(Post.id)]).where(and_(Post.author_id == User.uid, live)).as_scalar()))
+    session.commit()
+
+def ensure_trash():
+    """Makes the forum deleted threads go to, if there's none yet.  The web
+    app calls this before its first request."""
+    if not session.query(Forum).filter(Forum.trash == True).scalar():
+        print("No trash forum detected, making one")
+        f = Forum(name="Koš", identifier="kos", description="Smazané posty.", trash=True, position=255)
+        session.add(f)
+        session.commit()
+
 # XXX Watch out!  Code below main!
 
 if __name__ == "__main__":
     print('this is db.py.  make sure you know where you are.')
-    if input('fix thread.{pinned,archived} = NULL? ') == 'y':
-        for thread in session.query(Thread):
-            if thread.pinned == None:
-                thread.pinned = False
-            if thread.archived == None:
-                thread.archived = False
-        session.commit()
-        print("fixed")
+    print('(schema changes are in migrations/: alembic upgrade head)')
     if input('make everybody user?') == 'y':
         g = Group(name="user")
         session.add(g)
@@ -350,6 +602,9 @@ if __name__ == "__main__":
             user.groups.append(g)
         session.commit()
         print("done")
+    if input('recompute post counts? ') == 'y':
+        recompute_counts()
+        print("done")
     #if raw_input('mark everything as read for everybody? ') == 'y':
     #    for user in session.query(User):
     #        user.read_all()
@@ -362,10 +617,11 @@ if __name__ == "__main__":
         #    session.commit()
         if input('drop all? ') == 'y':
             print("... drop all")
-            Base.metadata.drop_all(bind=engine)
+            Base.metadata.drop_all(bind=get_engine())
         if input('create all? ') == 'y':
             print("... create all")
-            Base.metadata.create_all(bind=engine)
+            Base.metadata.create_all(bind=get_engine())
+            print("now run: alembic stamp head")
 
         if input('test entries? ') == 'y':
             print("... test entries")
@@ -396,12 +652,7 @@ if __name__ == "__main__":
             session.add(t)
 
             session.commit()
-
-
-if not session.query(Forum).filter(Forum.trash == True).scalar():
-    print("No trash forum detected, making one")
-    f = Forum(name="Koš", identifier="kos", description="Smazané posty.", trash=True, position=255)
-    session.add(f)
-    session.commit()
+    
+    ensure_trash()
 
 
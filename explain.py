@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+"""
+Prints the query plans of what the main forum pages run, to check that the
+indexes get used.  The pages are requested through a test client and every
+SELECT they make is EXPLAINed on the configured database (SQLite, PostgreSQL
+or MySQL).
+
+    ./explain.py               # as a guest
+    ./explain.py --user 12     # as user 12 (this marks what's shown as read!)
+
+For a before/after comparison:
+
+    alembic downgrade 4b8e0f1c2d3a; ./explain.py > before.txt
+    alembic upgrade head; ./explain.py > after.txt
+
+On PostgreSQL, ANALYZE first so that the planner knows the table sizes.
+"""
+import sys
+
+from sqlalchemy import event
+
+import db
+import rhweb2
+
+EXPLAIN = {
+    'sqlite': "EXPLAIN QUERY PLAN ",
+    'postgresql': "EXPLAIN ",
+    'mysql': "EXPLAIN ",
+}
+
+def busiest(model, count):
+    return db.session.query(model).order_by(count.desc()).first()
+
+def urls():
+    with rhweb2.app.test_request_context("/forum/"):
+        thread = busiest(db.Thread, db.Thread.post_count)
+        forum = busiest(db.Forum, db.Forum.thread_count)
+        user = busiest(db.User, db.User.post_count)
+        found = ["/forum/", "/forum/active"]
+        if forum: found.append(forum.url)
+        if thread: found += [thread.url, thread.url+"?from=last"]
+        if user: found.append(user.url+"/threads")
+    return found
+
+def capture(url, user_id=None):
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT") and not executemany:
+            statements.append((statement, parameters))
+    client = rhweb2.app.test_client()
+    if user_id:
+        with client.session_transaction() as session:
+            session['user_id'] = user_id
+    event.listen(db.get_engine(), "before_cursor_execute", before_cursor_execute)
+    try:
+        status = client.get(url).status_code
+    finally:
+        event.remove(db.get_engine(), "before_cursor_execute", before_cursor_execute)
+    return status, statements
+
+def explain(statement, parameters):
+    engine = db.get_engine()
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(EXPLAIN[engine.dialect.name] + statement, parameters)
+        rows = cursor.fetchall()
+    finally:
+        connection.close()
+    if engine.dialect.name == 'sqlite':
+        return [row[-1] for row in rows]
+    return [" | ".join(str(value) for value in row) for row in rows]
+
+if __name__ == "__main__":
+    user_id = None
+    if "--user" in sys.argv:
+        user_id = int(sys.argv[sys.argv.index("--user") + 1])
+    seen = set()
+    for url in urls():
+        status, statements = capture(url, user_id)
+        print("== GET {} ({}, {} queries)".format(url, status, len(statements)))
+        for statement, parameters in statements:
+            if statement in seen: continue
+            seen.add(statement)
+            print("-- " + " ".join(statement.split()))
+            for line in explain(statement, parameters):
+                print("   " + line)
+        print()
@@ -0,0 +1,34 @@
+import os
+from logging.config import fileConfig
+
+from alembic import context
+from flask import Config
+from sqlalchemy import create_engine
+
+app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+app_config = Config(app_dir)
+app_config.from_pyfile("config.py")
+
+config = context.config
+fileConfig(config.config_file_name)
+# Revisions are written by hand; importing db for its metadata would query
+# tables that may not exist yet.
+target_metadata = None
+
+def run_migrations_offline():
+    context.configure(url=app_config['DB'], target_metadata=target_metadata, literal_binds=True)
+    with context.begin_transaction():
+        context.run_migrations()
+
+def run_migrations_online():
+    engine = create_engine(app_config['DB'])
+    with engine.connect() as connection:
+        context.configure(connection=connection, target_metadata=target_metadata,
+            render_as_batch=engine.dialect.name == 'sqlite')
+        with context.begin_transaction():
+            context.run_migrations()
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,81 @@
+"""stored post counts, read watermarks and post head pointers
+
+The columns db.py's prompts used to add by hand.  Databases where that has
+been done already are left as they are.
+
+Revision ID: 4b8e0f1c2d3a
+Revises:
+Create Date: 2026-10-18 09:12:40.118305
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '4b8e0f1c2d3a'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+COLUMNS = (
+    ('users', sa.Column('post_count', sa.Integer, nullable=False, server_default='0')),
+    ('users', sa.Column('read_watermark', sa.DateTime)),
+    ('threads', sa.Column('post_count', sa.Integer, nullable=False, server_default='0')),
+    ('threads', sa.Column('last_post_id', sa.Integer, sa.ForeignKey('posts.id', name='fk_threads_last_post_id'))),
+    ('fora', sa.Column('thread_count', sa.Integer, nullable=False, server_default='0')),
+    ('fora', sa.Column('post_count', sa.Integer, nullable=False, server_default='0')),
+    ('fora', sa.Column('last_post_id', sa.Integer, sa.ForeignKey('posts.id', name='fk_fora_last_post_id'))),
+    ('posts', sa.Column('head_id', sa.Integer, sa.ForeignKey('posts.id', name='fk_posts_head_id'))),
+)
+
+posts = sa.table('posts', sa.column('id'), sa.column('thread_id'), sa.column('author_id'),
+    sa.column('timestamp'), sa.column('deleted'), sa.column('original_id'), sa.column('editstamp'), sa.column('head_id'))
+threads = sa.table('threads', sa.column('id'), sa.column('forum_id'), sa.column('post_count'), sa.column('last_post_id'))
+fora = sa.table('fora', sa.column('id'), sa.column('thread_count'), sa.column('post_count'), sa.column('last_post_id'))
+users = sa.table('users', sa.column('uid'), sa.column('post_count'))
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    added = set()
+    for table, column in COLUMNS:
+        if column.name not in [c['name'] for c in inspector.get_columns(table)]:
+            with op.batch_alter_table(table) as batch:
+                batch.add_column(column)
+            added.add((table, column.name))
+    
+    if 'fora_read' not in inspector.get_table_names():
+        op.create_table('fora_read',
+            sa.Column('id', sa.Integer, primary_key=True, nullable=False),
+            sa.Column('forum_id', sa.Integer, sa.ForeignKey('fora.id'), nullable=False),
+            sa.Column('user_id', sa.Integer, sa.ForeignKey('users.uid'), nullable=False),
+            sa.Column('timestamp', sa.DateTime))
+    
+    if ('posts', 'head_id') in added:
+        revision = posts.alias()
+        op.execute(posts.update().values(head_id=sa.select([revision.c.id])
+            .where(revision.c.original_id == posts.c.id)
+            .order_by(revision.c.editstamp.desc(), revision.c.id.desc()).limit(1).as_scalar()))
+    
+    if ('threads', 'post_count') in added:
+        # db.recompute_counts(), as of this revision
+        live = posts.c.deleted == sa.false()
+        op.execute(threads.update().values(
+            post_count=sa.select([sa.func.count(posts.c.id)]).where(sa.and_(posts.c.thread_id == threads.c.id, live)).as_scalar(),
+            last_post_id=sa.select([posts.c.id]).where(sa.and_(posts.c.thread_id == threads.c.id, live))
+                .order_by(posts.c.timestamp.desc(), posts.c.id.desc()).limit(1).as_scalar()))
+        thread = threads.alias()
+        op.execute(fora.update().values(
+            thread_count=sa.select([sa.func.count(thread.c.id)]).where(thread.c.forum_id == fora.c.id).as_scalar(),
+            post_count=sa.select([sa.func.coalesce(sa.func.sum(thread.c.post_count), 0)]).where(thread.c.forum_id == fora.c.id).as_scalar(),
+            last_post_id=sa.select([posts.c.id]).select_from(posts.join(thread, posts.c.thread_id == thread.c.id))
+                .where(sa.and_(thread.c.forum_id == fora.c.id, live))
+                .order_by(posts.c.timestamp.desc(), posts.c.id.desc()).limit(1).as_scalar()))
+        op.execute(users.update().values(
+            post_count=sa.select([sa.func.count(posts.c.id)]).where(sa.and_(posts.c.author_id == users.c.uid, live)).as_scalar()))
+
+
+def downgrade():
+    op.drop_table('fora_read')
+    for table, column in reversed(COLUMNS):
+        with op.batch_alter_table(table) as batch:
+            batch.drop_column(column.name)
@@ -0,0 +1,59 @@
+"""indexes for the hot queries, unique threads_read
+
+ - posts(thread_id, deleted, timestamp): a thread's posts, its pages and
+   counts, unread_threads()
+ - posts(author_id, deleted): users' post counts
+ - threads(forum_id, archived, pinned, laststamp): forum listings, whose
+   pages are found by comparing these, so old threads' NULLs get filled in
+   and the columns made NOT NULL first
+ - threads_read(user_id, thread_id), unique: last_read() and read()
+
+Revision ID: 9d27a5e6c413
+Revises: 4b8e0f1c2d3a
+Create Date: 2026-10-18 09:31:05.402671
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '9d27a5e6c413'
+down_revision = '4b8e0f1c2d3a'
+branch_labels = None
+depends_on = None
+
+posts = sa.table('posts', sa.column('thread_id'), sa.column('timestamp'))
+threads = sa.table('threads', sa.column('id'), sa.column('timestamp'), sa.column('laststamp'),
+    sa.column('pinned'), sa.column('archived'))
+
+
+def upgrade():
+    op.create_index('ix_posts_thread_deleted_timestamp', 'posts', ['thread_id', 'deleted', 'timestamp'])
+    op.create_index('ix_posts_author_deleted', 'posts', ['author_id', 'deleted'])
+    op.execute(threads.update().where(threads.c.pinned == None).values(pinned=sa.false()))
+    op.execute(threads.update().where(threads.c.archived == None).values(archived=sa.false()))
+    # the last post's time, or failing that the thread's
+    op.execute(threads.update().where(threads.c.laststamp == None).values(laststamp=sa.func.coalesce(
+        sa.select([sa.func.max(posts.c.timestamp)]).where(posts.c.thread_id == threads.c.id).as_scalar(),
+        threads.c.timestamp, datetime(1970, 1, 1))))
+    with op.batch_alter_table('threads') as batch:
+        batch.alter_column('pinned', existing_type=sa.Boolean, nullable=False)
+        batch.alter_column('archived', existing_type=sa.Boolean, nullable=False)
+        batch.alter_column('laststamp', existing_type=sa.DateTime, nullable=False)
+    op.create_index('ix_threads_forum_listing', 'threads', ['forum_id', 'archived', 'pinned', 'laststamp'])
+    # Racing requests could each insert a row; keep the latest one.  (The
+    # extra derived table is for MySQL, which won't otherwise delete from a
+    # table it's selecting from.)
+    op.execute("DELETE FROM threads_read WHERE id NOT IN (SELECT id FROM "
+        "(SELECT max(id) AS id FROM threads_read GROUP BY user_id, thread_id) AS keep)")
+    op.create_index('ix_threads_read_user_thread', 'threads_read', ['user_id', 'thread_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_threads_read_user_thread', 'threads_read')
+    op.drop_index('ix_threads_forum_listing', 'threads')
+    with op.batch_alter_table('threads') as batch:
+        batch.alter_column('laststamp', existing_type=sa.DateTime, nullable=True)
+    op.drop_index('ix_posts_author_deleted', 'posts')
+    op.drop_index('ix_posts_thread_deleted_timestamp', 'posts')
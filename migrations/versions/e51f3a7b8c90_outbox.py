@@ -0,0 +1,28 @@
+"""outbox for notifications
+
+Revision ID: e51f3a7b8c90
+Revises: 9d27a5e6c413
+Create Date: 2026-10-18 10:05:52.671930
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = 'e51f3a7b8c90'
+down_revision = '9d27a5e6c413'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('outbox',
+        sa.Column('id', sa.Integer, primary_key=True, nullable=False),
+        sa.Column('channel', sa.String(20), nullable=False),
+        sa.Column('message', sa.Text, nullable=False),
+        sa.Column('created', sa.DateTime),
+        sa.Column('attempts', sa.Integer, nullable=False, server_default='0'),
+        sa.Column('next_attempt', sa.DateTime))
+
+
+def downgrade():
+    op.drop_table('outbox')
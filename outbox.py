@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+"""
+Sends the notifications the forum queues in the outbox table (see
+rhforum.notify()) to Telegram, Discord and IRC, using report.py's senders.
+Messages are written in the same transaction as the post they announce and
+deleted only once sent, so each is delivered at least once, restarts and
+outages included.  Run one of these next to the web workers:
+
+    ./outbox.py           # keep draining, polling every OUTBOX_INTERVAL seconds
+    ./outbox.py --once    # send what's queued and exit
+    ./outbox.py --status  # how many messages wait, per channel
+
+A channel's messages wait until the oldest is COALESCE_DELAY seconds old, so
+that a burst goes out together, joined into as few posts as the channel's
+length limit allows, and no faster than RATE_LIMITS.  A failed send is
+retried with exponential backoff, up to OUTBOX_MAX_ATTEMPTS times.  If the
+service rejects a joined post (a 4xx), its messages are sent one by one, so
+that only the bad one is retried and eventually dropped.  The drainer
+prints the queue depth whenever it changes.
+
+Run only one drainer: the rate limits are counted per process.
+"""
+import sys
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_, func
+
+import db
+import report
+
+INTERVAL = db.app.config.get("OUTBOX_INTERVAL", 2)
+MAX_ATTEMPTS = db.app.config.get("OUTBOX_MAX_ATTEMPTS", 20)
+BACKOFF = 5
+MAX_BACKOFF = 60*60
+BATCH_SIZE = 100
+COALESCE_DELAY = db.app.config.get("OUTBOX_COALESCE_DELAY", 2)
+
+# The longest message each channel takes.
+LENGTH_LIMITS = {"telegram": 4096, "discord": 2000}
+
+class RateLimit(object):
+    """At most `count` sends per `seconds`, as a sliding window."""
+    def __init__(self, count, seconds):
+        self.count = count
+        self.seconds = seconds
+        self.sent = deque()
+    
+    def delay(self, now=None):
+        """Seconds until the next send is allowed, 0 if right now."""
+        now = time.time() if now is None else now
+        while self.sent and self.sent[0] <= now - self.seconds:
+            self.sent.popleft()
+        if len(self.sent) < self.count:
+            return 0
+        return self.sent[0] + self.seconds - now
+    
+    def take(self, now=None):
+        self.sent.append(time.time() if now is None else now)
+
+# What the services let a bot (a webhook) do.
+RATE_LIMITS = {"telegram": (20, 60), "discord": (30, 60)}
+rate_limits = {channel: RateLimit(*limit) for channel, limit in RATE_LIMITS.items()}
+
+def batches(rows, limit):
+    """Splits rows into runs whose messages fit in limit when joined by newlines."""
+    batch, length = [], -1
+    for row in rows:
+        if batch and limit and length + 1 + len(row.message) > limit:
+            yield batch
+            batch, length = [], -1
+        batch.append(row)
+        length += 1 + len(row.message)
+    if batch:
+        yield batch
+
+def failed(rows, now):
+    for row in rows:
+        row.attempts += 1
+        if row.attempts >= MAX_ATTEMPTS:
+            print("giving up on {} message {}: {}".format(row.channel, row.id, row.message))
+            db.session.delete(row)
+        else:
+            row.next_attempt = now + timedelta(seconds=min(BACKOFF * 2**row.attempts, MAX_BACKOFF))
+
+def rejected(ex):
+    """Whether the service refused the message itself (e.g. Telegram not
+    parsing its Markdown), as opposed to being down or rate limiting us."""
+    response = getattr(ex, 'response', None)
+    return response is not None and 400 <= response.status_code < 500 and response.status_code != 429
+
+def send(channel, rows, limit):
+    if limit: limit.take()
+    report.SENDERS[channel]("\n".join(row.message for row in rows))
+
+def send_each(channel, rows, now, limit):
+    """Sends rows one by one, so that a bad one fails alone.  Returns how
+    many it got to before the rate limit."""
+    handled = 0
+    for row in rows:
+        if limit and limit.delay():
+            break
+        try:
+            send(channel, [row], limit)
+        except Exception as ex:
+            print("{} send of message {} failed: {}: {}".format(channel, row.id, type(ex).__name__, ex))
+            failed([row], now)
+        else:
+            db.session.delete(row)
+        handled += 1
+    return handled
+
+def drain():
+    """Makes one pass over what's due.  Returns how many messages it sent or
+    failed, not counting those held back by COALESCE_DELAY or the rate limits."""
+    now = datetime.utcnow()
+    due = or_(db.Outbox.next_attempt == None, db.Outbox.next_attempt <= now)
+    # Each channel gets its own batch, so that one which is rate limited or
+    # keeps failing doesn't hold up the others.
+    channels = [channel for channel, in db.session.query(db.Outbox.channel).filter(due).distinct()]
+    handled = 0
+    for channel in sorted(channels):
+        limit = rate_limits.get(channel)
+        if limit and limit.delay():
+            continue
+        rows = db.session.query(db.Outbox).filter(db.Outbox.channel == channel, due)\
+            .order_by(db.Outbox.id).limit(BATCH_SIZE).all()
+        if not rows:
+            continue
+        if rows[0].created and rows[0].created > now - timedelta(seconds=COALESCE_DELAY):
+            continue # more of the burst may be coming
+        for batch in batches(rows, LENGTH_LIMITS.get(channel)):
+            if limit and limit.delay():
+                break # the rest waits for the next pass
+            try:
+                send(channel, batch, limit)
+            except Exception as ex:
+                print("{} send failed: {}: {}".format(channel, type(ex).__name__, ex))
+                if len(batch) > 1 and rejected(ex):
+                    handled += send_each(channel, batch, now, limit)
+                else:
+                    failed(batch, now)
+                    handled += len(batch)
+            else:
+                for row in batch:
+                    db.session.delete(row)
+                handled += len(batch)
+            db.session.commit()
+    db.session.close()
+    return handled
+
+def queue_depth():
+    """{channel: how many messages wait for it}"""
+    depth = dict(db.session.query(db.Outbox.channel, func.count(db.Outbox.id)).group_by(db.Outbox.channel))
+    db.session.close()
+    return depth
+
+def format_depth(depth):
+    return ", ".join("{} {}".format(channel, count) for channel, count in sorted(depth.items())) or "empty"
+
+if __name__ == "__main__":
+    if "--status" in sys.argv[1:]:
+        print(format_depth(queue_depth()))
+        exit()
+    once = "--once" in sys.argv[1:]
+    last_depth = {}
+    while True:
+        try:
+            handled = drain()
+            depth = queue_depth()
+            if depth != last_depth:
+                print("queue: " + format_depth(depth))
+                last_depth = depth
+        except Exception as ex:
+            print("drain failed: {}: {}".format(type(ex).__name__, ex))
+            db.session.rollback()
+            handled = 0
+        if handled < BATCH_SIZE:
+            if once: break
+            time.sleep(INTERVAL)
@@ -0,0 +1,106 @@
+# encoding: utf-8
+"""
+Counts the SQL queries each request makes and the time they take, and
+flags statements that ran over and over with different parameters - the
+usual sign of an N+1 (a relationship loaded lazily inside a loop).
+
+Every request logs a line with its numbers, as a warning if it looks like
+an N+1.  With QUERY_STATS = True in config.py (the default in debug mode)
+responses also carry them in an X-Query-Stats header.
+
+Tests can record around anything with record(); see query_budget in
+conftest.py.
+"""
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from flask import request, g
+from sqlalchemy import event
+
+# how many different parameter sets of one statement make an N+1
+REPEAT_THRESHOLD = 5
+
+local = threading.local()
+
+class QueryStats(object):
+    def __init__(self):
+        self.count = 0
+        self.time = 0
+        self.parameters = defaultdict(set)
+
+    def add(self, statement, parameters, elapsed):
+        self.count += 1
+        self.time += elapsed
+        self.parameters[statement].add(repr(parameters))
+
+    def repeated(self, threshold=REPEAT_THRESHOLD):
+        """{statement: how many parameter sets it ran with} for the ones that
+        ran with at least threshold of them."""
+        return {statement: len(parameters) for statement, parameters in self.parameters.items()
+            if len(parameters) >= threshold}
+
+    def summary(self):
+        return "{} queries, {:.1f} ms".format(self.count, self.time*1000)
+
+    def report(self, threshold=REPEAT_THRESHOLD):
+        lines = [self.summary()]
+        for statement, times in sorted(self.repeated(threshold).items(), key=lambda item: -item[1]):
+            lines.append("repeated {}x: {}".format(times, " ".join(statement.split())))
+        return "\n".join(lines)
+
+def recording():
+    if not hasattr(local, 'recording'):
+        local.recording = []
+    return local.recording
+
+@contextmanager
+def record():
+    """Collects the queries this thread makes inside the with block."""
+    stats = QueryStats()
+    recording().append(stats)
+    try:
+        yield stats
+    finally:
+        recording().remove(stats)
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    for stats in recording():
+        stats.add(statement, parameters, elapsed)
+
+def listen(engine):
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+def init_app(app):
+    """Records every request of app."""
+    @app.before_request
+    def start_recording():
+        g.query_stats = QueryStats()
+        recording().append(g.query_stats)
+
+    @app.after_request
+    def report(response):
+        stats = getattr(g, 'query_stats', None)
+        if stats is None:
+            return response
+        if app.config.get("QUERY_STATS", app.debug):
+            response.headers['X-Query-Stats'] = "{} queries; {:.1f} ms; {} repeated".format(
+                stats.count, stats.time*1000, len(stats.repeated()))
+        if stats.repeated():
+            app.logger.warning("{} {}: possible N+1: {}".format(request.method, request.full_path, stats.report()))
+        elif stats.count:
+            app.logger.info("{} {}: {}".format(request.method, request.full_path, stats.summary()))
+        return response
+
+    @app.teardown_request
+    def stop_recording(exception):
+        # here rather than in report(), which an unhandled exception skips
+        stats = getattr(g, 'query_stats', None)
+        if stats in recording():
+            recording().remove(stats)
@@ -1,13 +1,9 @@
 #!/bin/usr/env python
 
 
-import multiprocessing
-import time
 import os
 from sys import argv
 
-from codecs import open
-
 import json
 import requests
 
@@ -18,22 +14,30 @@ import requests
 #app.config.from_pyfile(app_dir+"/config.py") # XXX
 import config
 
+# The senders raise on failure; outbox.py retries them.  They share one
+# pooled session, so a worker keeps its connections open between messages.
+TIMEOUT = 10
+http = requests.Session()
+
+TELEGRAM_API = getattr(config, "TELEGRAM_API", "https://api.telegram.org")
+
 def telegram_post(method, **params):
-    for i in range(3):
-        try:
-            return requests.post("https://api.telegram.org/bot{}/{}".format(config.TELEGRAM_TOKEN, method), data=params).json()
-        except Exception as ex:
-            print("Failed to post to Telegram: {}: {}".format(type(ex), ex))
-            time.sleep(1)
+    r = http.post("{}/bot{}/{}".format(TELEGRAM_API, config.TELEGRAM_TOKEN, method), data=params, timeout=TIMEOUT)
+    r.raise_for_status()
+    return r.json()
 
 def report_telegram(message):
     telegram_post("sendMessage", chat_id=config.TELEGRAM_CHAT_ID, text=message,
         parse_mode="Markdown", disable_web_page_preview=True)
 
 def report_irc(message):
-    f = open(config.IRC_IN, 'w', encoding='utf-8')
-    message = message.decode('utf-8') + "\n"
-    f.write(message)
+    if isinstance(message, bytes):
+        message = message.decode('utf-8')
+    # Without O_NONBLOCK this would wait for the bot to open the FIFO
+    # forever; this way it fails (ENXIO) and gets retried.
+    fd = os.open(config.IRC_IN, os.O_WRONLY | os.O_NONBLOCK)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(message + "\n")
 
 def report_mattermost(message):
     payload = {
@@ -42,39 +46,31 @@ def report_mattermost(message):
         'username': 'rhbot',
         'icon_url': "https://mattermost.test.retroherna.cz/api/v3/users/68qfcbhggt8ympgfhtayr3pjrw/image"
     }
-    r = requests.post(config.MATTERMOST_URL, data={'payload': json.dumps(payload)})
-    print(r)
+    r = http.post(config.MATTERMOST_URL, data={'payload': json.dumps(payload)}, timeout=TIMEOUT)
+    r.raise_for_status()
 
 def report_discord(message):
     payload = {
         'content': message,
     }
-    r = requests.post(config.DISCORD_URL,
+    r = http.post(config.DISCORD_URL,
         headers={"Content-Type": "application/json"},
-        data=json.dumps(payload))
-    print(r, r.text)
+        data=json.dumps(payload), timeout=TIMEOUT)
+    r.raise_for_status()
 
+SENDERS = {"irc": report_irc,
+    "telegram": report_telegram,
+    "mattermost": report_mattermost,
+    "discord": report_discord}
 
 if __name__ == '__main__':
     method = argv[1]
     message = argv[2]
-
-    func = {"irc": report_irc,
-        "telegram": report_telegram,
-        "mattermost": report_mattermost,
-        "discord": report_discord}[method]
     
-    func_ = lambda: func(message)
-
-    p = multiprocessing.Process(target=func_)
-    p.start()
-
-    p.join(10)
-
-    if p.is_alive():
-        print("timeout")
-        p.terminate()
-        p.join()
+    try:
+        SENDERS[method](message)
+    except Exception as ex:
+        print("Failed to send to {}: {}: {}".format(method, type(ex).__name__, ex))
         exit(1)
-
-print("sent?")
+    
+    print("sent")
@@ -9,23 +9,28 @@ import time
 import re
 
 import db
-from sqlalchemy import or_, and_, not_, asc, desc, func
-from datetime import datetime, timedelta
+from sqlalchemy import or_, and_, not_, asc, desc, func, literal
+from sqlalchemy.orm import joinedload, contains_eager
+from datetime import datetime, timedelta, timezone
 from functools import wraps # We need this to make Flask understand decorated routes.
 import hashlib
+from collections import namedtuple
 
-import subprocess
 
 from lxml.html.clean import Cleaner
 from lxml.etree import ParserError
 
 from werkzeug import secure_filename
-from flask import Flask, Blueprint, render_template, request, flash, redirect, session, abort, url_for, make_response, g
+from flask import Flask, Blueprint, render_template, request, flash, redirect, session, abort, url_for, make_response, g, Markup, current_app
 from wtforms import Form, BooleanField, TextField, TextAreaField, PasswordField, RadioField, SelectField, SelectMultipleField, BooleanField, IntegerField, HiddenField, SubmitField, validators, ValidationError, widgets
 from wtforms.fields.html5 import DateTimeLocalField
 
 import requests
 
+from caching import LRUCache, stamp, bump
+import assets
+import querystats
+
 def now():
     if app.config['DB'].startswith('postgresql+psycopg2'):
         # https://stackoverflow.com/questions/796008/cant-subtract-offset-naive-and-offset-aware-datetimes/17752647#17752647
@@ -50,19 +55,38 @@ class MultiCheckboxField(SelectMultipleField):
 app_dir = os.path.dirname(os.path.abspath(__file__))
 app = Flask('rhforum', template_folder=app_dir+"/templates")
 app.config.from_pyfile(app_dir+"/config.py") # XXX
+assets.init_app(app)
+querystats.init_app(app)
 BASE_URL = app.config.get("BASE_URL", "")
 
 rhforum = Blueprint('rhforum', __name__,
     template_folder='templates',
     static_folder='static')
 
+# Guests all see the same pages, so those get cached whole.  Every cached page
+# depends on a few scopes ("thread-12", "index", ...); writes bump the scopes'
+# stamp files in cache/guest/, which all workers check before serving a page.
+GUEST_CACHE_DIR = app_dir+"/cache/guest"
+GUEST_CACHE_ARGS = ("reply", "from", "post")
+guest_cache = LRUCache(app.config.get("GUEST_CACHE_SIZE", 512), app.config.get("GUEST_CACHE_TTL", 60))
+
+# Rendered post texts, see post_html().
+post_html_cache = LRUCache(app.config.get("POST_HTML_CACHE_SIZE", 4096))
+
+POSTS_PER_PAGE = app.config.get("POSTS_PER_PAGE", 50)
+THREADS_PER_PAGE = app.config.get("THREADS_PER_PAGE", 50)
+
 doku = None
-if app.config.get("DOKU_URL", ""):
-    from dokuwiki import DokuWiki
-    try:
-        doku = DokuWiki(app.config['DOKU_URL'], app.config['DOKU_USER'], app.config['DOKU_PASS'])
-    except Exception as ex:
-        print("Failed to connect to DokuWiki: ", ex)
+
+def get_doku():
+    """The forum's wiki client, made on first use, or None without DOKU_URL.
+    Failures show up in the thread view as doku_error."""
+    global doku
+    if doku is None and app.config.get("DOKU_URL", ""):
+        from wikiclient import WikiClient
+        doku = WikiClient(app.config['DOKU_URL'], app.config['DOKU_USER'], app.config['DOKU_PASS'],
+            timeout=app.config.get("WIKI_TIMEOUT", 10))
+    return doku
 
 
 class PostForm(Form):
@@ -126,14 +150,26 @@ def bbcode(text):
     text = re.sub("\[\/quote\]", "</blockquote>", text)
     return text
 
+@rhforum.app_template_global('post_html')
+def post_html(post):
+    """The post's text through the filters in forum/_post_text.html.  Posts
+    don't change once written (edits are new posts), so this is done once
+    per post and worker; deleting one bumps its editstamp, which is part of
+    the key too."""
+    key = (post.id, post.editstamp)
+    html = post_html_cache.get(key)
+    if html is None:
+        html = Markup(current_app.jinja_env.get_template("forum/_post_text.html").render(text=post.text))
+        post_html_cache.set(key, html)
+    return html
+
+@rhforum.before_app_first_request
+def bootstrap():
+    # rather than on import, so that starting a worker doesn't touch the DB
+    db.ensure_trash()
+
 @rhforum.before_request
 def before_request():
-    if not hasattr(g, 'telegram_messages'):
-        g.telegram_messages = []
-    if not hasattr(g, 'irc_messages'):
-        g.irc_messages = []
-    if not hasattr(g, 'discord_messages'):
-        g.discord_messages = []
     if 'user_id' in session:
         g.user = db.session.query(db.User).get(session['user_id'])
         if not g.user:
@@ -142,6 +178,7 @@ def before_request():
         g.user.laststamp = now()
     else:
         g.user = db.Guest()
+    db.refresh_groups()
     g.now = now()
     g.yesterday = g.now - timedelta(days=1)
     g.tomorrow = g.now + timedelta(days=1)
@@ -151,20 +188,15 @@ def before_request():
 
 @rhforum.after_request
 def after_request(response):
-    try:
-        while g.telegram_messages:
-            message = g.telegram_messages.pop(0)
-            subprocess.Popen(["python", app_dir+"/report.py", "telegram", message.encode('utf-8')])
-            
-        while g.irc_messages:
-            message = g.irc_messages.pop(0)
-            subprocess.Popen(["python", app_dir+"/report.py", "irc", message.encode('utf-8')])
-            
-        while g.discord_messages:
-            message = g.discord_messages.pop(0)
-            subprocess.Popen(["python", app_dir+"/report.py", "discord", message.encode('utf-8')])
-    except Exception as ex:
-        print(type(ex), ex)
+    if getattr(g, 'last_modified', None) and response.status_code in (200, 304):
+        response.last_modified = g.last_modified
+        # make browsers ask every time rather than guess from the date
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+    
+    if getattr(g, 'guest_cache_entry', None) and response.status_code == 200 and not response.direct_passthrough:
+        key, started = g.guest_cache_entry
+        guest_cache.set(key, (list(response.headers), response.get_data(), started))
     
     return response
             
@@ -174,6 +206,43 @@ def shutdown_session(exception=None):
     db.session.close()
     db.session.remove()
 
+def notify(channel, message):
+    """Queues a message for outbox.py to send to "telegram", "discord" or
+    "irc".  It goes in with whatever the request commits next, so call this
+    before committing."""
+    db.session.add(db.Outbox(channel=channel, message=message, created=now()))
+
+def invalidate(*scopes):
+    """Throws away cached guest pages depending on any of the scopes, in all
+    workers.  Call after committing."""
+    for scope in scopes:
+        bump(GUEST_CACHE_DIR+"/"+scope)
+
+def invalidate_thread(thread):
+    invalidate("thread-{}".format(thread.id), "forum-{}".format(thread.forum_id), "index", "active")
+
+def guest_cached(scopes):
+    """Serves guests' GETs of the view from guest_cache.  scopes gets the
+    view's arguments and returns the scopes the page depends on (besides
+    "all", which everything does)."""
+    def decorator(f):
+        @wraps(f)
+        def decorated(**kwargs):
+            if g.user or request.method != 'GET' or '_flashes' in session:
+                return f(**kwargs)
+            key = (request.path,) + tuple(request.args.get(arg) for arg in GUEST_CACHE_ARGS)
+            cached = guest_cache.lookup(key)
+            if cached and not cached[1]:
+                headers, data, started = cached[0]
+                if all(stamp(GUEST_CACHE_DIR+"/"+scope) < started for scope in ["all"] + scopes(**kwargs)):
+                    response = app.response_class(data, headers=headers)
+                    return response.make_conditional(request)
+            # anything written from now on may be missing from this render
+            g.guest_cache_entry = (key, time.time_ns())
+            return f(**kwargs)
+        return decorated
+    return decorator
+
 def sort_tasks(tasks):
     return []
     now = g.now
@@ -248,25 +317,175 @@ def page_not_found(e):
 def page_not_found(e):
     return render_template('forum/errorpage.html', error=400), 400
 
+# What thread listings show of each thread, loaded along with it.
+thread_listing = (joinedload(db.Thread.author), joinedload(db.Thread.last_post).joinedload(db.Post.author))
+# Likewise for thread.html and each post: author and editor along with
+# their groups (for titles and admin checks).
+post_listing = (joinedload(db.Post.author).selectinload(db.User.groups),
+    joinedload(db.Post.editor).selectinload(db.User.groups))
+
+# Listing orders as (column, descending) pairs.  The last column is unique,
+# so every row has a key of its own to seek to.
+thread_order = ((db.Thread.archived, False), (db.Thread.pinned, True), (db.Thread.laststamp, True), (db.Thread.id, True))
+post_order = ((db.Post.timestamp, False), (db.Post.id, False))
+
+# count is the number of pages; starts are the `from` cursors of the pages
+# worth linking to from this one, by number
+Page = namedtuple('Page', "items number count starts")
+
+# how many pages around the current one get linked (besides the first and last)
+PAGE_LINKS_AROUND = 2
+
+def seek(order, key, inclusive=True):
+    """Condition for the rows after the one with the given key (its values of
+    the order columns), and that one too if inclusive."""
+    clauses = []
+    for i, (column, descending) in enumerate(order):
+        same = [c == value for (c, d), value in zip(order[:i], key)]
+        # (as a literal, since SQLAlchemy won't compare with a bare True/False)
+        value = literal(key[i], column.type)
+        clauses.append(and_(*same, column < value if descending else column > value))
+    if inclusive:
+        clauses.append(and_(*[c == value for (c, d), value in zip(order, key)]))
+    return or_(*clauses)
+
+def paginate(query, order, per_page, cursor=None):
+    """Returns the Page of query containing the row with id `cursor`, the last
+    page for "last" and the first one otherwise.  The cursor's page number
+    comes from counting the rows before it, and the page is read by seeking
+    back and forth from the cursor, so nothing reads the whole listing."""
+    columns = [column for column, descending in order]
+    ordering = [column.desc() if descending else column for column, descending in order]
+    backwards = [column if descending else column.desc() for column, descending in order]
+    query = query.order_by(None)
+    total = query.with_entities(func.count(columns[-1])).scalar()
+    
+    key = None
+    index = 0
+    if cursor == "last":
+        index = max(total - 1, 0)
+    elif cursor is not None:
+        key = query.with_entities(*columns).filter(columns[-1] == cursor).first()
+        if key:
+            index = query.with_entities(func.count(columns[-1])).filter(not_(seek(order, key))).scalar()
+    start = index // per_page * per_page
+    
+    if cursor == "last":
+        items = query.order_by(*backwards).limit(total - start).all()[::-1]
+    elif key:
+        # the page's rows before the cursor, then the rest from it on
+        items = query.filter(not_(seek(order, key))).order_by(*backwards).limit(index - start).all()[::-1] if index > start else []
+        items += query.filter(seek(order, key)).order_by(*ordering).limit(per_page - len(items)).all()
+    else:
+        items = query.order_by(*ordering).limit(per_page).all()
+    
+    number = start // per_page + 1
+    count = max((total + per_page - 1) // per_page, 1)
+    starts = {1: None, count: "last"}
+    if items and number not in starts:
+        starts[number] = items[0].id
+    # The pages around this one start every per_page rows away from its edges.
+    first = max(number - PAGE_LINKS_AROUND, 2)
+    last = min(number + PAGE_LINKS_AROUND, count - 1)
+    if items and first < number:
+        key = [getattr(items[0], column.key) for column in columns]
+        before = [id for id, in query.with_entities(columns[-1]).filter(not_(seek(order, key)))
+            .order_by(*backwards).limit((number - first) * per_page)]
+        for other in range(first, number):
+            if (number - other) * per_page <= len(before):
+                starts.setdefault(other, before[(number - other) * per_page - 1])
+    if items and last > number:
+        key = [getattr(items[-1], column.key) for column in columns]
+        after = [id for id, in query.with_entities(columns[-1]).filter(seek(order, key, inclusive=False))
+            .order_by(*ordering).limit((last - number - 1) * per_page + 1)]
+        for other in range(number + 1, last + 1):
+            if (other - number - 1) * per_page < len(after):
+                starts.setdefault(other, after[(other - number - 1) * per_page])
+    return Page(items, number, count, starts)
+
+@rhforum.app_template_global('page_urls')
+def page_urls(page):
+    """(number, url) of the pages to link to, keeping the current URL's other
+    arguments, with (None, None) where some are skipped."""
+    args = request.args.to_dict()
+    for arg in ("from", "post", "reply"):
+        args.pop(arg, None)
+    urls = []
+    for number in sorted(page.starts):
+        if urls and number > urls[-1][0] + 1:
+            urls.append((None, None))
+        start = page.starts[number]
+        page_args = dict(args, **{'from': start}) if start is not None else args
+        urls.append((number, url_for(request.endpoint, **dict(request.view_args, **page_args))))
+    return urls
+
+def can_see(forum):
+    """Whether g.user is in the group the forum's category is limited to, if any."""
+    category = forum.category
+    return not category or not category.group_id or category.group_id in g.user.group_ids
+
 def get_active_threads():
     threads = db.session.query(db.Thread).join(db.Forum).outerjoin(db.Category)\
-        .filter(or_(db.Forum.category_id==None, db.Category.group_id.in_([None, 0]), db.Category.group_id.in_(group.id for group in g.user.groups)))\
+        .filter(or_(db.Forum.category_id==None, db.Category.group_id==None, db.Category.group_id==0, db.Category.group_id.in_(g.user.group_ids)))\
         .filter(db.Forum.trash == False) \
         .order_by(db.Thread.laststamp.desc())
     
     return threads
 
+def last_change(threads):
+    """When anything shown in the given threads last changed: a new post, an
+    edit or a deletion."""
+    threads = threads.order_by(None)
+    laststamp = threads.with_entities(func.max(db.Thread.laststamp)).scalar()
+    editstamp = db.session.query(func.max(db.Post.editstamp))\
+        .filter(db.Post.thread_id.in_(threads.with_entities(db.Thread.id).subquery())).scalar()
+    stamps = [stamp for stamp in (laststamp, editstamp) if stamp]
+    return max(stamps) if stamps else None
+
+def last_invalidated(scopes):
+    """When invalidate() was last called on any of the guest cache scopes (or
+    "all"), rounded up to the second; None if never."""
+    ns = max(stamp(GUEST_CACHE_DIR+"/"+scope) for scope in ("all",) + scopes)
+    return datetime.utcfromtimestamp(-(-ns // 10**9)) if ns else None
+
+def not_modified(threads, *scopes):
+    """Returns a 304 response if the guest's copy of a page showing the given
+    threads is current.  Logged in users always get the full page, as it
+    depends on what they've read (and viewing it marks things read).
+    scopes are the page's guest cache scopes: changes that move no stamp in
+    the threads, like pinning one or moving it elsewhere, invalidate those."""
+    if g.user or request.method != 'GET' or '_flashes' in session:
+        return None
+    stamps = [stamp for stamp in (last_change(threads), last_invalidated(scopes)) if stamp]
+    last_modified = max(stamps) if stamps else None
+    if not last_modified:
+        return None
+    g.last_modified = last_modified.replace(tzinfo=None, microsecond=0)
+    since = request.if_modified_since
+    if since and since.tzinfo:
+        since = since.astimezone(timezone.utc).replace(tzinfo=None)
+    if since and since >= g.last_modified:
+        return make_response("", 304)
+    return None
+
 @rhforum.route("/", methods="GET POST".split())
+@guest_cached(lambda: ["index"])
 def index():
     form = None
     if g.user:
         form = ForumControlsForm(request.form)
         if request.method == "POST":# and form.validate():
             if form.mark_read.data:
-                g.user.read_all()
+                g.user.read_all(now())
     
-    categories = db.session.query(db.Category).order_by(db.Category.position).all()
-    uncategorized_fora = db.session.query(db.Forum).filter(db.Forum.category == None, db.Forum.trash == False).order_by(db.Forum.position).all()
+    # Every forum's newest post is kept in forum.last_post, so this one query
+    # has all the categories, fora and their last posts.
+    categories = db.session.query(db.Category).order_by(db.Category.position)\
+        .options(joinedload(db.Category.group),
+            joinedload(db.Category.fora).joinedload(db.Forum.last_post).joinedload(db.Post.author),
+            joinedload(db.Category.fora).joinedload(db.Forum.last_post).joinedload(db.Post.thread)).all()
+    uncategorized_fora = db.session.query(db.Forum).filter(db.Forum.category == None, db.Forum.trash == False).order_by(db.Forum.position)\
+        .options(joinedload(db.Forum.last_post).joinedload(db.Post.author), joinedload(db.Forum.last_post).joinedload(db.Post.thread)).all()
     trash = db.session.query(db.Forum).filter(db.Forum.trash == True).scalar()
     if uncategorized_fora:
         categories.append(None)
@@ -275,13 +494,21 @@ def index():
     tasks = db.session.query(db.Task).filter(db.Task.user_id.in_([g.user.id, None, 0])).all()
     sort_tasks(tasks)
     
-    return render_template("forum/index.html", categories=categories, uncategorized_fora=uncategorized_fora, edit_forum = None, latest_threads=latest_threads, trash=trash, form=form, tasks=tasks)
+    shown_threads = list(latest_threads) + [forum.last_post.thread for category in categories
+        for forum in (category.fora if category else uncategorized_fora) if forum.last_post]
+    unread = g.user.unread_threads(shown_threads)
+    
+    return render_template("forum/index.html", categories=categories, uncategorized_fora=uncategorized_fora, edit_forum = None, latest_threads=latest_threads, trash=trash, form=form, tasks=tasks, unread=unread)
 
 @rhforum.route("/active", methods="GET POST".split())
+@guest_cached(lambda: ["active"])
 def active():
+    response = not_modified(get_active_threads(), "active")
+    if response: return response
     form = ForumControlsForm(request.form)
-    active_threads = get_active_threads()[0:100]
-    return render_template("forum/active.html", active_threads=active_threads, form=form)
+    # symbol_name needs the forum, its category and its group
+    active_threads = get_active_threads().options(contains_eager(db.Thread.forum).contains_eager(db.Forum.category).joinedload(db.Category.group))[0:100]
+    return render_template("forum/active.html", active_threads=active_threads, form=form, unread=g.user.unread_threads(active_threads))
 
 @rhforum.route("/edit-forum/<int:forum_id>", endpoint="edit_forum", methods="GET POST".split())
 @rhforum.route("/edit-forum/new", endpoint="edit_forum", methods="GET POST".split())
@@ -346,6 +573,7 @@ def edit_forum_or_category(forum_id=None, category_id=None):
                 else:
                     flash("Kategorie upravena.")
             db.session.commit()
+            invalidate("all")
             return redirect(url_for('.index'))
         elif form.delete.data:
             if request.endpoint == 'rhforum.edit_forum':
@@ -361,16 +589,20 @@ def edit_forum_or_category(forum_id=None, category_id=None):
                         else:
                             moved = False
                     db.session.delete(forum)
+                    if form.new_forum_id.data:
+                        db.refresh_counts(new_forum)
                     if moved:
                         flash("Fórum odstraněno a témata přesunuty.")
                     else:
                         flash("Fórum odstraněno.")
                     db.session.commit()
+                    invalidate("all")
                     return redirect(url_for('.index'))
             elif request.endpoint == 'rhforum.edit_category':
                 db.session.delete(category)
                 flash("Kategorie odstraněna.")
                 db.session.commit()
+                invalidate("all")
                 return redirect(url_for('.index'))
         else:
             # moving
@@ -388,6 +620,7 @@ def edit_forum_or_category(forum_id=None, category_id=None):
                 x.position = i
                 db.session.add(x)
             db.session.commit()
+            invalidate("all")
             if request.endpoint == 'rhforum.edit_category':
                 categories = items
     if editable.position == 0:
@@ -462,17 +695,18 @@ def register():
             if user_group:
                 user.groups.append(user_group)
             db.session.add(user)
-            db.session.commit()
+            db.session.flush()
             
-            g.telegram_messages.append("Nová registrace: *{}* (login *{}*, email {}): {}".format(
+            notify("telegram", "Nová registrace: *{}* (login *{}*, email {}): {}".format(
                 user.fullname, user.login, user.email, BASE_URL+user.url))
-            g.irc_messages.append("Nová registrace: \x0302{}\x03 (login \x0208{}\x03, email {}): {}".format(
+            notify("irc", "Nová registrace: \x0302{}\x03 (login \x0208{}\x03, email {}): {}".format(
                 user.fullname, user.login, user.email, BASE_URL+user.url))
-            #g.discord_messages.append("Nová registrace: **{}** (login **{}**, email {}): {}".format(
+            #notify("discord", "Nová registrace: **{}** (login **{}**, email {}): {}".format(
             #    user.fullname, user.login, user.email, BASE_URL+user.url))
+            db.session.commit()
             
             g.user = user
-            g.user.read_all()
+            g.user.read_all(now())
             session['user_id'] = g.user.id
             session.permanent = True
             
@@ -490,12 +724,18 @@ def logout():
 
 @rhforum.route("/<int:forum_id>", methods="GET POST".split())
 @rhforum.route("/<int:forum_id>-<forum_identifier>", methods="GET POST".split())
+@guest_cached(lambda forum_id, **kwargs: ["forum-{}".format(forum_id)])
 def forum(forum_id, forum_identifier=None):
     forum = db.session.query(db.Forum).get(forum_id)
     if not forum: abort(404)
-    if forum.category and forum.category.group and forum.category.group not in g.user.groups: abort(403)
+    if not can_see(forum): abort(403)
     if forum.trash and not g.user.admin: abort(403)
-    threads = db.session.query(db.Thread).filter(db.Thread.forum == forum).order_by(db.Thread.archived.asc(), db.Thread.pinned.desc(), db.Thread.laststamp.desc())
+    threads = db.session.query(db.Thread).filter(db.Thread.forum == forum)
+    response = not_modified(threads, "forum-{}".format(forum.id))
+    if response: return response
+    if g.user and request.method == 'POST' and 'mark_read' in request.form:
+        g.user.read_forum(forum, dtnow())
+        return redirect(forum.url)
     form = None
     if not forum.trash:
         form = ThreadForm(request.form)
@@ -507,16 +747,25 @@ def forum(forum_id, forum_identifier=None):
             post = db.Post(thread=thread, author=g.user, timestamp=now,
                 text=form.text.data)
             db.session.add(post)
-            db.session.commit()
-            g.telegram_messages.append("Nové téma od *{}*: *{}*: {}".format(
+            db.count_new_post(post, new_thread=True)
+            notify("telegram", "Nové téma od *{}*: *{}*: {}".format(
                 thread.author.name, thread.name, BASE_URL+thread.short_url))
             if (not forum.category) or (not forum.category.group): # TODO should may report user too 
-                g.discord_messages.append("Nové téma od **{}**: **{}**: {}".format(
+                notify("discord", "Nové téma od **{}**: **{}**: {}".format(
                     thread.author.name, thread.name, BASE_URL+thread.short_url))
-                g.irc_messages.append("Nové téma od \x0302{}\x03: \x0306{}\x03: {}".format(
+                notify("irc", "Nové téma od \x0302{}\x03: \x0306{}\x03: {}".format(
                     thread.author.name, thread.name, BASE_URL+thread.short_url))
+            db.session.commit()
+            invalidate_thread(thread)
             return redirect(thread.url)
-    return render_template("forum/forum.html", forum=forum, threads=threads, form=form)
+    cursor = request.args.get("from")
+    if cursor and cursor != "last":
+        try:
+            cursor = int(cursor)
+        except ValueError:
+            abort(400)
+    page = paginate(threads.options(*thread_listing), thread_order, THREADS_PER_PAGE, cursor)
+    return render_template("forum/forum.html", forum=forum, threads=page.items, page=page, form=form, unread=g.user.unread_threads(page.items))
 
 @rhforum.route("/users/<int:user_id>/threads")
 @rhforum.route("/users/<int:user_id>-<name>/threads")
@@ -529,19 +778,20 @@ def user_threads(user_id, name=None):
     threads = db.session.query(db.Thread).join(db.Forum)\
         .filter(db.Forum.trash == False, db.Thread.author == user)\
         .outerjoin(db.Category)\
-        .filter(or_(db.Forum.category_id==None, db.Category.group_id.in_([None, 0]), db.Category.group_id.in_(group.id for group in g.user.groups)))\
-        .filter(db.Forum.trash == False).order_by(db.Thread.laststamp.desc()).all()
+        .filter(or_(db.Forum.category_id==None, db.Category.group_id==None, db.Category.group_id==0, db.Category.group_id.in_(g.user.group_ids)))\
+        .filter(db.Forum.trash == False).order_by(db.Thread.laststamp.desc()).options(*thread_listing).all()
     
-    return render_template("forum/forum.html", forum=forum, threads=threads, user=user)
+    return render_template("forum/forum.html", forum=forum, threads=threads, user=user, unread=g.user.unread_threads(threads))
     
 
 # TODO <path:thread_identificator>
 @rhforum.route("/<int:forum_id>/<int:thread_id>", methods="GET POST".split())
 @rhforum.route("/<int:forum_id>-<forum_identifier>/<int:thread_id>-<thread_identifier>", methods="GET POST".split())
+@guest_cached(lambda thread_id, **kwargs: ["thread-{}".format(thread_id)])
 def thread(forum_id, thread_id, forum_identifier=None, thread_identifier=None):
     thread = db.session.query(db.Thread).get(thread_id)
     if not thread: abort(404)
-    if thread.forum.category and thread.forum.category.group and thread.forum.category.group not in g.user.groups: abort(403)
+    if not can_see(thread.forum): abort(403)
     if thread.forum.trash and not g.user.admin: abort(403)
     reply_post = None
     if "reply" in request.args:
@@ -555,12 +805,29 @@ def thread(forum_id, thread_id, forum_identifier=None, thread_identifier=None):
         if reply_post and reply_post.thread != thread:
             abort(400)
     
-    if g.user.admin and "show_deleted" in request.args:
-        posts = thread.posts.filter()
+    response = not_modified(db.session.query(db.Thread).filter(db.Thread.id == thread.id), "thread-{}".format(thread.id))
+    if response: return response
+    
+    show_deleted = g.user.admin and "show_deleted" in request.args
+    if show_deleted:
+        posts = thread.posts
     else:
         posts = thread.posts.filter(db.Post.deleted==False)
     
-    num_deleted = thread.posts.count() - thread.posts.filter(db.Post.deleted==False).count()
+    # ?post= is a permalink, ?from= a page link; both show the page with that
+    # post.  ?from=last is the page with #post-latest.
+    cursor = request.args.get("post") or request.args.get("from")
+    if cursor and cursor != "last":
+        try:
+            cursor = int(cursor)
+        except ValueError:
+            abort(400)
+        linked = db.session.query(db.Post).get(cursor)
+        if linked and linked.deleted and not show_deleted:
+            # an old revision; show the post as it is now
+            cursor = linked.current.id
+    
+    num_deleted = thread.posts.filter(db.Post.deleted==True).count()
     
     form = None
     if not thread.forum.trash and not (thread.locked and not g.user.admin):
@@ -574,23 +841,23 @@ def thread(forum_id, thread_id, forum_identifier=None, thread_identifier=None):
                 text=form.text.data)
             db.session.add(post)
             thread.laststamp = now
-            db.session.commit()
-            g.telegram_messages.append("Nový příspěvek od *{}* do *{}*: {}".format(
+            db.count_new_post(post)
+            notify("telegram", "Nový příspěvek od *{}* do *{}*: {}".format(
                 post.author.name, post.thread.name, BASE_URL+post.short_url))
             if (not thread.forum.category) or (not thread.forum.category.group): # TODO should may report user too 
-                g.discord_messages.append("Nový příspěvek od **{}** do **{}**: {}".format(
+                notify("discord", "Nový příspěvek od **{}** do **{}**: {}".format(
                     post.author.name, post.thread.name, BASE_URL+post.short_url))
-                g.irc_messages.append("Nový příspěvek od \x0302{}\x03 do \x0306{}\x03: {}".format(
+                notify("irc", "Nový příspěvek od \x0302{}\x03 do \x0306{}\x03: {}".format(
                     post.author.name, post.thread.name, BASE_URL+post.short_url))
-            return redirect(thread.url+"#post-latest") # TODO id
+            db.session.commit()
+            invalidate_thread(thread)
+            post_html(post)
+            return redirect(post.url)
+    
+    page = paginate(posts.options(*post_listing), post_order, POSTS_PER_PAGE, cursor)
     
     if g.user:
-        thread_read = db.session.query(db.ThreadRead).filter(db.ThreadRead.user==g.user, db.ThreadRead.thread==thread).first()
-        if not thread_read:
-            last_read_timestamp = None
-        else:
-            last_read_timestamp = thread_read.last_post.timestamp
-        g.user.read(thread.last_post)
+        last_read_timestamp = g.user.last_read(thread)
     else:
         last_read_timestamp = g.now
         
@@ -598,17 +865,23 @@ def thread(forum_id, thread_id, forum_identifier=None, thread_identifier=None):
     article_revisions = []
     article_info = None
     doku_error = None
-    if thread.wiki_article and doku:
+    if thread.wiki_article and get_doku():
         try:
-            article = doku.pages.html(thread.wiki_article)
+            article, article_info = get_doku().parallel(
+                ("wiki.getPageHTML", thread.wiki_article),
+                ("wiki.getPageInfo", thread.wiki_article))
             #article_revisions = doku.send("wiki.getPageVersions", thread.wiki_article)
-            article_info = doku.send("wiki.getPageInfo", thread.wiki_article)
             print(article_info, 'xxx')
         except Exception as ex:
             print(ex)
             doku_error = ex
     
-    return render_template("forum/thread.html", thread=thread, forum=thread.forum, posts=posts, form=form, now=dtnow(), last_read_timestamp=last_read_timestamp, article=article, article_revisions=article_revisions, article_info=article_info, doku_error=doku_error, reply_post=reply_post, show_deleted="show_deleted" in request.args, num_deleted=num_deleted)
+    rendered = render_template("forum/thread.html", thread=thread, forum=thread.forum, posts=page.items, page=page, form=form, now=dtnow(), last_read_timestamp=last_read_timestamp, article=article, article_revisions=article_revisions, article_info=article_info, doku_error=doku_error, reply_post=reply_post, show_deleted=show_deleted, num_deleted=num_deleted)
+    # only now, as read() commits, which expires (and so reloads one by one)
+    # all the posts the page shows
+    if g.user and page.items:
+        g.user.read(page.items[-1])
+    return rendered
 
 @rhforum.route("/<int:forum_id>/<int:topic_id>/set", methods="POST".split())
 @rhforum.route("/<int:forum_id>-<forum_identifier>/<int:thread_id>-<thread_identifier>/set", methods="POST".split())
@@ -632,6 +905,7 @@ def thread_set(forum_id, thread_id, forum_identifier=None, thread_identifier=Non
     elif request.form.get("unarchive"):
         thread.archived = False
     db.session.commit()
+    invalidate_thread(thread)
     
     return redirect(thread.url)
 
@@ -641,7 +915,7 @@ def edit_post(forum_id, thread_id, post_id, forum_identifier=None, thread_identi
     post = db.session.query(db.Post).get(post_id)
     thread = db.session.query(db.Thread).get(thread_id)
     if not post: abort(404)
-    if thread.forum.category and thread.forum.category.group and thread.forum.category.group not in g.user.groups: abort(403)
+    if not can_see(thread.forum): abort(403)
     if post.thread != thread: abort(400)
     if post.deleted:
         # The user probably hit edit multiple times.  Let's just be helpful.
@@ -649,8 +923,10 @@ def edit_post(forum_id, thread_id, post_id, forum_identifier=None, thread_identi
     if post.author != g.user and not g.user.admin: abort(403)
     if post.thread.forum.trash and not g.user.admin: abort(403)
     posts = thread.posts.filter(db.Post.deleted==False)
+    first_post = posts.order_by(None).order_by(db.Post.timestamp, db.Post.id).first()
+    page = paginate(posts.options(*post_listing), post_order, POSTS_PER_PAGE, post.id)
     
-    if post == posts[0] and g.user.admin:
+    if post == first_post and g.user.admin:
         edit_thread = True
         form = EditThreadForm(request.form, text=post.text, name=thread.name, forum_id=thread.forum_id, wiki_article=thread.wiki_article)
         forums = db.session.query(db.Forum).outerjoin(db.Category).order_by(db.Category.position, db.Forum.position).all()
@@ -662,28 +938,39 @@ def edit_post(forum_id, thread_id, post_id, forum_identifier=None, thread_identi
     if not g.user.admin: del form.delete
     
     if request.method == 'POST' and form.validate():
+        old_forum_id = thread.forum_id
         if form.submit.data:
             now = dtnow()
+            original = post.original or post
             new_post = db.Post(thread=thread, author=post.author, timestamp=post.timestamp, editstamp=now,
-                text=form.text.data, original=post.original if post.original else post, editor=g.user)
+                text=form.text.data, original=original, editor=g.user)
             db.session.add(new_post)
+            original.head = new_post
             post.deleted=True
             if edit_thread:
                thread.name = form.name.data
                thread.forum_id = form.forum_id.data
                thread.wiki_article = form.wiki_article.data
                #forum.fix_laststamp() # TODO
+            db.refresh_counts(thread, *{db.session.query(db.Forum).get(forum_id) for forum_id in (old_forum_id, thread.forum_id)})
             db.session.commit()
+            invalidate_thread(thread)
+            invalidate("forum-{}".format(old_forum_id))
             if edit_thread:
                 return redirect(thread.url)
             else:
                 return redirect(new_post.url)
         elif form.delete.data:
             post.deleted = True
+            # so that the thread's Last-Modified moves too
+            post.editstamp = dtnow()
+            post.editor = g.user
+            db.refresh_counts(thread, thread.forum, post.author)
             db.session.commit()
+            invalidate_thread(thread)
             return redirect(thread.url)
     
-    return render_template("forum/thread.html", thread=thread, forum=thread.forum, posts=posts, form=form, now=dtnow(), edit_post=post, edit_thread=edit_thread, last_read_timestamp=g.now)
+    return render_template("forum/thread.html", thread=thread, forum=thread.forum, posts=page.items, page=page, form=form, now=dtnow(), edit_post=post, edit_thread=edit_thread, last_read_timestamp=g.now)
 
 @rhforum.route("/users/")
 def users():
@@ -729,6 +1016,8 @@ def edit_user(user_id, name=None):
             for group_id in form.group_ids.data:
                 user.groups.append(db.session.query(db.Group).get(group_id))
         db.session.commit()
+        db.groups_changed()
+        invalidate("all")
         flash("Uživatel upraven.")
         return redirect(user.url)
     
@@ -754,6 +1043,7 @@ def groups(edit_group_id=None):
         group = db.Group(name="")
         db.session.add(group)
         db.session.commit()
+        db.groups_changed()
         return redirect(url_for('.groups', edit_group_id=group.id))
     if edit_group_id:
         edit_group = db.session.query(db.Group).get(edit_group_id)
@@ -765,6 +1055,8 @@ def groups(edit_group_id=None):
         edit_group.rank = form.rank.data
         edit_group.display = form.display.data
         db.session.commit()
+        db.groups_changed()
+        invalidate("all")
         flash("Skupina {} upravena.".format(edit_group.name))
         return redirect(url_for('.groups'))
     
@@ -837,7 +1129,8 @@ def irc_send():
     form = IRCSendForm(request.form)
     if request.method == 'POST' and form.validate():
         text = form.text.data
-        g.irc_messages.append(text)
+        notify("irc", text)
+        db.session.commit()
         
         form = IRCSendForm()
     
@@ -848,7 +1141,7 @@ app.register_blueprint(rhforum, url_prefix='')
 if not app.debug:
     import logging
     from logging import FileHandler
-    file_handler = FileHandler(app_dir+'/flask.log')
+    file_handler = FileHandler(app_dir+'/flask.log', delay=True) # opened on the first warning
     file_handler.setLevel(logging.WARNING)
     formatter = logging.Formatter('%(asctime)s - %(message)s')
     file_handler.setFormatter(formatter)
@@ -1,107 +1,225 @@
 #!/usr/bin/python3
 import os
+import time
+import threading
+import hashlib
+from collections import namedtuple
 
-from flask import Blueprint, Flask, render_template, render_template_string, request, flash, redirect, session, abort, url_for, make_response, g, send_from_directory
+from flask import Blueprint, Flask, Config, current_app, render_template, render_template_string, request, flash, redirect, session, abort, url_for, make_response, g, send_from_directory
 
-from dokuwiki import DokuWiki, DokuWikiError
-from bs4 import BeautifulSoup
+from dokuwiki import DokuWikiError
 
 import rhforum
+import assets
+import querystats
+from wikiclient import WikiClient
+from caching import LRUCache, file_lock, write_atomic
+from wikitransform import transform_wikipage, to_html, page_title, page_description
 
-app = Flask('rhweb2')
 app_dir = os.path.dirname(os.path.abspath(__file__))
-app.config.from_pyfile(app_dir+"/config.py") # XXX
+# The settings, for use at import time; apps made by create_app() get a copy.
+config = Config(app_dir)
+config.from_pyfile(app_dir+"/config.py") # XXX
 
 DOKUUSER = "rhweb"
-DOKUPASS = open(app_dir+'/DOKUPASS').read().strip()
 DOKUURL = "https://retroherna.org/wiki"
 
-wiki = DokuWiki(DOKUURL, DOKUUSER, DOKUPASS)
+wiki = None
+
+def get_wiki():
+    """The wiki client, made on first use.  (It logs in on its first call.)"""
+    global wiki
+    if wiki is None:
+        wiki = WikiClient(DOKUURL, DOKUUSER, open(app_dir+'/DOKUPASS').read().strip(),
+            timeout=config.get("WIKI_TIMEOUT", 10))
+    return wiki
 
 rhweb = Blueprint('rhweb', __name__, template_folder='templates', static_folder='static')
 
 
+# With WIKI_SYNC, wikisync.py keeps cache/ up to date and requests never talk
+# to the wiki themselves.
+WIKI_SYNC = config.get("WIKI_SYNC", False)
+
+wiki_cache = LRUCache(config.get("WIKI_CACHE_SIZE", 256), config.get("WIKI_CACHE_TTL", 300))
+wiki_refreshing = set()
+wiki_refreshing_lock = threading.Lock()
+
+def wikipage_path(name):
+    return app_dir+"/cache/"+name+".html"
+
+def load_wikipage(name):
+    path = wikipage_path(name)
+    page = open(path).read()
+    # Without the sync daemon, a file's age is the age of its content.
+    wiki_cache.set(name, page, stamp=None if WIKI_SYNC else os.path.getmtime(path))
+    return page
+
+def fetch_wikipage(name):
+    # Doesn't touch g, so this is safe to run outside of a request.
+    path = wikipage_path(name)
+    started = time.time()
+    # One fetch per page at a time across all workers; whoever waited for the
+    # lock gets the page the holder just wrote instead of asking the wiki again.
+    with file_lock(path+".lock"):
+        try:
+            if os.path.getmtime(path) >= started:
+                return load_wikipage(name)
+        except EnvironmentError:
+            pass
+        
+        page = get_wiki().pages.html(name)
+        
+        if not page:
+            # remember missing pages too, so that 404s don't hit the wiki each time
+            wiki_cache.set(name, "")
+            return None
+        
+        write_atomic(path, page)
+    
+    wiki_cache.set(name, page)
+    return page
+
+def refresh_wikipage(name):
+    """Refetches a page in a background thread, at most once at a time."""
+    if WIKI_SYNC:
+        # just pick up whatever wikisync.py wrote last
+        try:
+            load_wikipage(name)
+        except EnvironmentError:
+            wiki_cache.set(name, "")
+        return
+    
+    with wiki_refreshing_lock:
+        if name in wiki_refreshing: return
+        wiki_refreshing.add(name)
+    
+    logger = current_app.logger
+    def refresh():
+        try:
+            fetch_wikipage(name)
+        except Exception as ex:
+            logger.warning("{} background refresh fail: {}".format(name, ex))
+            # keep serving what we have and retry after another TTL
+            wiki_cache.touch(name)
+        finally:
+            with wiki_refreshing_lock:
+                wiki_refreshing.discard(name)
+    
+    thread = threading.Thread(target=refresh, name="refresh "+name)
+    thread.daemon = True
+    thread.start()
+
 def wikipage(name, force=False):
     name = name.replace("/", ":")
     
     if not force and not g.purge:
+        cached = wiki_cache.lookup(name)
+        if cached:
+            page, stale = cached
+            if stale:
+                g.caching_comment += "{} stale in memory, refreshing\n".format(name)
+                refresh_wikipage(name)
+            else:
+                g.caching_comment += "{} read from memory\n".format(name)
+            return page or None
+    
+    if not force and (not g.purge or WIKI_SYNC):
         try:
-            page = open(app_dir+"/cache/"+name+".html").read()
+            page = load_wikipage(name)
             g.caching_comment += "{} read from cache\n".format(name)
+            cached = wiki_cache.lookup(name)
+            # None if other pages already pushed it out; then we can't tell
+            # its age, and one background refresh is cheap
+            if cached is None or cached[1]:
+                refresh_wikipage(name)
             return page
         except Exception as ex:
             g.caching_comment += "{} cache open fail: {}\n".format(name, ex)
     
-    page = None
-    for i in range(3):
+    if WIKI_SYNC:
+        wiki_cache.set(name, "")
+        return None
+    
+    # Nothing to serve (or purging), so we have to wait for the wiki.
+    try:
+        page = fetch_wikipage(name)
+    except Exception as ex:
+        g.caching_comment += "{} get wiki page fail: {}\n".format(name, ex)
         try:
-            page = wiki.pages.html(name)
-            break
+            return open(wikipage_path(name)).read()
         except Exception as ex:
-            g.caching_comment += "{} get wiki page fail {}: {}\n".format(name, i, ex)
+            g.caching_comment += "cache open fail w force: {}\n".format(ex)
+            return None
     
     if page:
         g.caching_comment += "{} got fresh wiki page\n".format(name)
     
-    if not page and force:
-        try:
-            return open(app_dir+"/cache/"+page+".html").read().decode('utf-8')
-        except Exception as ex:
-            g.caching_comment += "cache open fail w force: {}\n".format(ex)
+    return page
+
+CompiledPage = namedtuple('CompiledPage', "hash source has_heading title description template")
+
+compiled_cache = LRUCache(config.get("WIKI_CACHE_SIZE", 256))
+
+def compile_wikipage(name, page):
+    """Transforms a wiki page into a ready-to-render template, along with its
+    title and description.  The result is kept until the page's content changes."""
+    digest = hashlib.sha1(page.encode('utf-8')).hexdigest()
+    compiled = compiled_cache.get(name)
+    if compiled and compiled.hash == digest:
+        return compiled
     
-    if not page:
-        return None
+    section = transform_wikipage(page)
+    has_heading, title = page_title(section)
     
-    open(app_dir+"/cache/"+name+".html", "w").write(page)
+    source = """{% extends '_base.html' %}
+{% block content %}
+""" + to_html(section) + """
+{% endblock %}
+"""
     
-    return page
+    compiled = CompiledPage(hash=digest, source=source, has_heading=has_heading,
+        title=title, description=page_description(section), template=current_app.jinja_env.from_string(source))
+    compiled_cache.set(name, compiled)
+    return compiled
 
-def transform_wikipage(page):
-    page = page.replace("~CLEAR~", '<div style="clear: both;"></div>')
-    page = page.replace("retroherna.cz", "retroherna.org")
-    page = BeautifulSoup(page, "lxml")
-    for a in page.find_all('a'):
-        if a.get('href') and "/wiki/doku.php" in a['href']:
-            a['href'] = a['href'].replace("/wiki/doku.php?id=web:", "/").replace(':', '/')
-    
-    for img in page.find_all('img'):
-        if not img['src'].startswith("http"):
-            img['src'] = img['src'].replace("/wiki/lib/exe/fetch.php", "https://retroherna.org/wiki/lib/exe/fetch.php")
-        title = img.get('title')
-        
-        parent = img.parent
-        if parent.name == "a" and parent['href'].startswith("/wiki"):
-            parent.name = "div"
-            del parent['href']
-        else:
-            parent = page.new_tag("div")
-            img.wrap(parent)
-        classes = img.get('class')
-        parent['class'] = classes + [" mediawrap"]
-        if 'mediacenter' in classes and img.get('width'):
-            # life is too short
-            parent['style'] = 'width: {}px;'.format(img['width'])
-        del img['class']
-        
-        # XXX yes this is necessary, thanks dokuwiki
-        if title and not any(title.endswith(t) for t in ("png", "jpg", "jpeg", "gif")):
-            title = page.new_tag("div")
-            title['class'] = "mediatitle"
-            if img.get('width'):
-                title['style'] = "max-width: {}px;".format(img['width'])
-            title.string = img['title']
-            parent.append(title)
-    
-    page = page.html.body
-    page.name = "section"
-    
-    #page = "".join(str(page))
-    return page
+# Goes into page ETags, so that new templates (or assets, whose URLs they
+# contain) don't get stuck behind a 304.
+TEMPLATES_VERSION = hashlib.sha1(b"".join(open(path, 'rb').read()
+    for path in (app_dir+"/templates/_base.html", app_dir+"/templates/_macros.html", assets.MANIFEST_PATH)
+    if os.path.exists(path))).hexdigest()[:16]
+
+def page_etag(compiled):
+    return hashlib.sha1("{} {} {}".format(compiled.hash, g.sidebar_version, TEMPLATES_VERSION).encode('utf-8')).hexdigest()
+
+def render_compiled(template, **context):
+    # render_template_string, minus compiling the template on every request
+    current_app.update_template_context(context)
+    return template.render(context)
 
 def render_wikipage(wikipage, **kwargs):
-    wikipage = str(transform_wikipage(wikipage))
+    wikipage = to_html(transform_wikipage(wikipage))
     return render_template_string(wikipage, **kwargs)
 
+Sidebar = namedtuple('Sidebar', "version html")
+
+sidebar = Sidebar(None, "")
+sidebar_lock = threading.Lock()
+
+def get_sidebar():
+    """Returns the rendered sidebar, rebuilding it only when its wiki page
+    changes.  The same render is shared by every request and thread, so the
+    sidebar shouldn't depend on anything request-specific."""
+    global sidebar
+    page = wikipage("web2:sidebar") or ""
+    version = hashlib.sha1(page.encode('utf-8')).hexdigest()[:16]
+    if sidebar.version == version:
+        return sidebar
+    with sidebar_lock:
+        if sidebar.version != version:
+            sidebar = Sidebar(version, render_wikipage(page) if page else "")
+        return sidebar
+
 @rhweb.before_request
 def before_request():
     g.caching_comment = ""
@@ -114,12 +232,14 @@ def before_request():
     #g.banner = transform_wikipage(wikipage("web:banner"))
     #g.footer = transform_wikipage(wikipage("web:footer"))
     if not request.path.startswith("/static"):
-        g.sidebar = render_wikipage(wikipage("web2:sidebar"), force=True)
+        current_sidebar = get_sidebar()
+        g.sidebar = current_sidebar.html
+        g.sidebar_version = current_sidebar.version
     
     g.pagetitle = None
     g.dokuwiki_url = DOKUURL
 
-@app.context_processor
+@rhweb.app_context_processor
 def new_template_globals():
     urls = {
         "facebook": "https://facebook.com/retroherna",
@@ -153,36 +273,26 @@ def page(path):
     #else:
     page = wikipage("web2:"+path.replace("/", ":"))
     if not page: abort(404)
-    page = transform_wikipage(page)
-    
-    h1 = page.find('h1')
-    h2 = page.find('h2')
-    h3 = page.find('h3')
-    if h1:
-        g.pagetitle = h1.string
-    elif h2:
-        g.pagetitle = h2.string
-    elif h3:
-        g.pagetitle = h3.string
+    compiled = compile_wikipage("web2:"+path.replace("/", ":"), page)
+    
+    etag = page_etag(compiled)
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+        response.set_etag(etag)
+        return response
+    
+    if compiled.has_heading:
+        g.pagetitle = compiled.title
     elif path == "index":
         g.pagetitle = None
     else:
         g.pagetitle = path
-        
-    g.pagedescription = ""    
-    for p in page.find_all('p'):
-        text = p.get_text().strip()
-        if text and len(text) > 30:
-            g.pagedescription = text
-            break
-    
-    page = """{% extends '_base.html' %}
-{% block content %}
-""" + str(page) + """
-{% endblock %}
-"""
     
-    return render_template_string(page, path=path, page=page)
+    g.pagedescription = compiled.description
+    
+    response = make_response(render_compiled(compiled.template, path=path, page=compiled.source))
+    response.set_etag(etag)
+    return response
 
 #@app.route("/o-nas")
 #def o_nas():
@@ -211,12 +321,23 @@ def clanky():
     return render_template("clanky.html")
 """
 
-@app.route("/robots.txt")
 def static_from_root():
-    return send_from_directory(app.static_folder, request.path[1:])
+    return send_from_directory(current_app.static_folder, request.path[1:])
+
+def create_app():
+    """Makes the app.  Neither this nor importing the modules connects to
+    anything: the database, the wikis and the forum's trash get set up on
+    first use (see db.get_engine(), get_wiki() and rhforum.bootstrap())."""
+    app = Flask('rhweb2')
+    app.config.from_mapping(config)
+    assets.init_app(app)
+    querystats.init_app(app)
+    app.add_url_rule("/robots.txt", 'static_from_root', static_from_root)
+    app.register_blueprint(rhweb, url_prefix='')
+    app.register_blueprint(rhforum.rhforum, url_prefix='/forum')
+    return app
 
-app.register_blueprint(rhweb, url_prefix='')
-app.register_blueprint(rhforum.rhforum, url_prefix='/forum')
+app = create_app()
 
 if __name__ == "__main__":
     app.config['TEMPLATES_AUTO_RELOAD'] = True
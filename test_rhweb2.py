@@ -1,4 +1,6 @@
+import re
 import pytest
+from datetime import datetime
 from bs4 import BeautifulSoup as BS
 
 MAGIC = "I6w4vAfFzvXV7S936ZNkRFQqer99WwjiTozu1xY6"
@@ -65,3 +67,393 @@ def test_forum_login(client, user, password, valid):
     else:
         assert page.status_code == 302
 
+
+def test_index_etag(client):
+    index = client.get("/")
+    assert index.status_code == 200
+    etag = index.headers["ETag"]
+    again = client.get("/", headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert not again.data
+
+@pytest.mark.parametrize("thread", [False, True])
+def test_forum_last_modified(client, forum_db, thread):
+    thread_url, posts = forum_db.make_thread()
+    url = thread_url if thread else forum_db.forum_url
+    page = client.get(url)
+    assert page.status_code == 200
+    last_modified = page.headers["Last-Modified"]
+    again = client.get(url, headers={"If-Modified-Since": last_modified})
+    assert again.status_code == 304
+    
+    login(client)
+    page = client.get(url, headers={"If-Modified-Since": last_modified})
+    assert page.status_code == 200
+
+def test_last_modified_follows_invalidation(client, forum_db):
+    import time
+    thread_url, posts = forum_db.make_thread()
+    guest = client.application.test_client()
+    urls = [forum_db.forum_url, thread_url]
+    last_modified = {url: guest.get(url).headers["Last-Modified"] for url in urls}
+    # Last-Modified has whole seconds
+    time.sleep(1.1)
+    login(client)
+    # locking moves no post or thread stamp
+    assert client.post(thread_url+"/set", data=dict(lock="1")).status_code == 302
+    for url in urls:
+        assert guest.get(url, headers={"If-Modified-Since": last_modified[url]}).status_code == 200
+
+def test_guest_cache_invalidation(client, forum_db):
+    url, posts = forum_db.make_thread()
+    guest = client.application.test_client()
+    assert guest.get(url).status_code == 200
+    
+    text = "guest cache test " + MAGIC[::-1]
+    assert text not in guest.get(url).data.decode('utf-8')
+    login(client)
+    reply = client.post(url, data=dict(text=text))
+    assert reply.status_code == 302
+    assert text in guest.get(url).data.decode('utf-8')
+
+def test_assets_rewrite_css():
+    import assets
+    manifest = {"img/a.png": "img/a.0123456789.png"}
+    css = """a {background: url('img/a.png')} b {background: url("/static/img/a.png")} c {background: url(data:x)}"""
+    assert assets.rewrite_css("style.css", css, manifest) == \
+        """a {background: url('/static/dist/img/a.0123456789.png')} b {background: url("/static/dist/img/a.0123456789.png")} c {background: url(data:x)}"""
+
+def test_mark_read(client, forum_db):
+    forum_db.make_thread()
+    other_id, other_url = forum_db.make_forum("jine")
+    forum_db.make_thread(forum_id=other_id)
+    login(client)
+    assert b"new-icon" in client.get(forum_db.forum_url).data
+    assert client.post(forum_db.forum_url, data=dict(mark_read="1")).status_code == 302
+    assert b"new-icon" not in client.get(forum_db.forum_url).data
+    assert b"new-icon" in client.get("/forum/active").data
+    assert client.post("/forum/", data=dict(mark_read="1")).status_code == 200
+    assert b"new-icon" not in client.get("/forum/active").data
+
+def test_read_covered_by_forum(client, forum_db):
+    import db
+    url, posts = forum_db.make_thread()
+    login(client)
+    assert client.post(forum_db.forum_url, data=dict(mark_read="1")).status_code == 302
+    assert client.get(url).status_code == 200
+    # the forum's watermark already says so
+    assert db.session.query(db.ThreadRead).count() == 0
+    db.session.close()
+    assert client.post(url, data=dict(text="newer")).status_code == 302
+    assert client.get(url).status_code == 200
+    assert db.session.query(db.ThreadRead).count() == 1
+    db.session.close()
+
+def test_thread_pages(client, forum_db, monkeypatch):
+    import rhforum
+    monkeypatch.setattr(rhforum, "POSTS_PER_PAGE", 2)
+    url, posts = forum_db.make_thread(5)
+    login(client)
+    first = BS(client.get(url).data, "lxml")
+    assert first.find(id="post-{}".format(posts[0])) and not first.find(id="post-{}".format(posts[2]))
+    assert not first.find(id="post-latest")
+    links = first.find(class_="pagination").find_all("a")
+    assert len(links) >= 2
+    second = BS(client.get(links[0]["href"]).data, "lxml")
+    assert second.find(id="post-{}".format(posts[2])) and not second.find(id="post-{}".format(posts[0]))
+    # permalinks land on the page with the post
+    assert BS(client.get(url+"?post={}".format(posts[4])).data, "lxml").find(id="post-{}".format(posts[4]))
+    assert not first.find(id="post-{}".format(posts[4]))
+    assert BS(client.get(url+"?from=last").data, "lxml").find(id="post-latest")
+    assert client.get(url+"?from=x").status_code == 400
+
+def test_thread_page_numbers(client, forum_db, monkeypatch):
+    import rhforum
+    monkeypatch.setattr(rhforum, "POSTS_PER_PAGE", 1)
+    monkeypatch.setattr(rhforum, "PAGE_LINKS_AROUND", 1)
+    url, posts = forum_db.make_thread(6)
+    login(client)
+    for number, post_id in enumerate(posts, 1):
+        page = BS(client.get(url+"?post={}".format(post_id)).data, "lxml")
+        assert [div["id"] for div in page.find_all(class_="fragment") if div["id"] != "post-latest"][0] == "post-{}".format(post_id)
+        pagination = page.find(class_="pagination")
+        assert pagination.find("strong").string == str(number)
+        # only the first, the last and the neighbours are linked
+        linked = {int(a.string) for a in pagination.find_all("a")}
+        assert linked == {1, number - 1, number + 1, len(posts)} - {0, number, len(posts) + 1}
+        assert ("…" in pagination.text) == (number - 1 > 2 or len(posts) - number > 2)
+        for a in pagination.find_all("a"):
+            target = BS(client.get(a["href"]).data, "lxml")
+            assert target.find(class_="pagination").find("strong").string == a.string
+
+def test_forum_pages(client, forum_db, monkeypatch):
+    import rhforum
+    monkeypatch.setattr(rhforum, "THREADS_PER_PAGE", 1)
+    forum_db.make_thread(name="first thread")
+    forum_db.make_thread(name="second thread")
+    login(client)
+    first = BS(client.get(forum_db.forum_url).data, "lxml")
+    assert len(first.find_all(class_="row")) == 1
+    links = first.find(class_="pagination").find_all("a")
+    second = BS(client.get(links[0]["href"]).data, "lxml")
+    assert len(second.find_all(class_="row")) == 1
+    assert second.find(class_="row-text")["href"] != first.find(class_="row-text")["href"]
+
+@pytest.mark.parametrize("window", [True, False])
+def test_latest_posts(forum_db, monkeypatch, window):
+    import db
+    monkeypatch.setattr(db, "window_functions", lambda: window)
+    other_id, other_url = forum_db.make_forum("jine")
+    first = forum_db.make_thread(3)[1]
+    second = forum_db.make_thread(2, forum_id=other_id)[1]
+    third = forum_db.make_thread(2)[1]
+    # the newest post of all, but deleted
+    db.session.query(db.Post).get(third[-1]).deleted = True
+    db.session.commit()
+    thread_of = dict(db.session.query(db.Post.id, db.Post.thread_id))
+    assert db.latest_posts(db.Post.thread_id) == {thread_of[first[0]]: first[-1],
+        thread_of[second[0]]: second[-1], thread_of[third[0]]: third[0]}
+    assert db.latest_posts(db.Thread.forum_id) == {forum_db.forum_id: third[0], other_id: second[-1]}
+    db.session.close()
+
+def test_post_html_cache(client, forum_db):
+    import rhforum
+    from flask import Markup
+    url, posts = forum_db.make_thread()
+    url += "?post={}".format(posts[-1])
+    login(client)
+    assert "post 4 of test thread" in client.get(url).data.decode('utf-8')
+    assert "post 4 of test thread" in rhforum.post_html_cache.get((posts[-1], None))
+    rhforum.post_html_cache.set((posts[-1], None), Markup("cached render"))
+    assert b"cached render" in client.get(url).data
+
+def test_outbox(client, forum_db, monkeypatch):
+    import db, outbox, report
+    url, posts = forum_db.make_thread()
+    login(client)
+    reply = client.post(url, data=dict(text="outbox test"))
+    assert reply.status_code == 302
+    queued = db.session.query(db.Outbox).order_by(db.Outbox.id).all()
+    assert {row.channel for row in queued} == {"telegram", "discord", "irc"}
+    db.session.close()
+    
+    sent = []
+    def fail(message):
+        raise IOError("down")
+    monkeypatch.setattr(report, "SENDERS", {"telegram": sent.append, "discord": sent.append, "irc": fail})
+    monkeypatch.setattr(outbox, "COALESCE_DELAY", 0)
+    assert outbox.drain() == 3
+    assert len(sent) == 2 and all("Nový příspěvek" in message for message in sent)
+    left = db.session.query(db.Outbox).all()
+    assert [(row.channel, row.attempts) for row in left] == [("irc", 1)]
+    assert left[0].next_attempt > datetime.utcnow()
+    db.session.close()
+    # not due yet
+    assert outbox.drain() == 0
+
+def test_outbox_coalescing(forum_db, monkeypatch):
+    import db, outbox, report
+    sent = []
+    monkeypatch.setattr(report, "SENDERS", {"discord": sent.append})
+    monkeypatch.setattr(outbox, "rate_limits", {"discord": outbox.RateLimit(1, 60)})
+    for i in range(3):
+        db.session.add(db.Outbox(channel="discord", message="burst {}".format(i), created=datetime.utcnow()))
+    db.session.commit()
+    # the burst might not be over yet
+    assert outbox.drain() == 0
+    assert sent == []
+    assert outbox.queue_depth() == {"discord": 3}
+    monkeypatch.setattr(outbox, "COALESCE_DELAY", 0)
+    assert outbox.drain() == 3
+    assert sent == ["burst 0\nburst 1\nburst 2"]
+    assert outbox.queue_depth() == {}
+    # over the rate limit, so this one waits
+    db.session.add(db.Outbox(channel="discord", message="limited", created=datetime.utcnow()))
+    db.session.commit()
+    assert outbox.drain() == 0
+    assert len(sent) == 1
+    assert outbox.queue_depth() == {"discord": 1}
+
+def test_outbox_rejected(forum_db, monkeypatch):
+    import db, outbox, report, requests
+    sent = []
+    def telegram(message):
+        if "bad_name" in message:
+            response = requests.Response()
+            response.status_code = 400
+            raise requests.HTTPError("can't parse entities", response=response)
+        sent.append(message)
+    monkeypatch.setattr(report, "SENDERS", {"telegram": telegram})
+    monkeypatch.setattr(outbox, "COALESCE_DELAY", 0)
+    for message in ("first", "bad_name", "last"):
+        db.session.add(db.Outbox(channel="telegram", message=message, created=datetime.utcnow()))
+    db.session.commit()
+    assert outbox.drain() == 3
+    # only the bad one is left to retry
+    assert sent == ["first", "last"]
+    assert [(row.message, row.attempts) for row in db.session.query(db.Outbox)] == [("bad_name", 1)]
+    db.session.close()
+
+def test_outbox_blocked_channel(forum_db, monkeypatch):
+    import db, outbox, report
+    sent = []
+    monkeypatch.setattr(report, "SENDERS", {"discord": sent.append, "telegram": sent.append})
+    monkeypatch.setattr(outbox, "COALESCE_DELAY", 0)
+    monkeypatch.setattr(outbox, "BATCH_SIZE", 2)
+    # discord used up its rate limit and sorts first with more than a batch waiting
+    discord = outbox.RateLimit(1, 60)
+    discord.take()
+    monkeypatch.setattr(outbox, "rate_limits", {"discord": discord})
+    for i in range(3):
+        db.session.add(db.Outbox(channel="discord", message="held {}".format(i), created=datetime.utcnow()))
+    db.session.add(db.Outbox(channel="telegram", message="pending", created=datetime.utcnow()))
+    db.session.commit()
+    assert outbox.drain() == 1
+    assert sent == ["pending"]
+    assert outbox.queue_depth() == {"discord": 3}
+
+def test_outbox_batches():
+    import outbox
+    from collections import namedtuple
+    Row = namedtuple('Row', "message")
+    rows = [Row("x"*10) for i in range(5)]
+    assert [len(batch) for batch in outbox.batches(rows, 31)] == [2, 2, 1]
+    assert [len(batch) for batch in outbox.batches(rows, None)] == [5]
+    assert [len(batch) for batch in outbox.batches([Row("x"*50)] + rows, 31)] == [1, 2, 2, 1]
+
+@pytest.fixture
+def standin(monkeypatch):
+    """A local HTTP server in place of Telegram and Discord, recording what
+    gets posted to it.  Answers with the status in standin.status."""
+    import threading, report
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            server.posts.append((self.path, self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')))
+            self.send_response(server.status)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(b'{"ok": true}')
+        def log_message(self, *args):
+            pass
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    server.posts = []
+    server.status = 200
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}".format(server.server_port)
+    monkeypatch.setattr(report, "TELEGRAM_API", url)
+    monkeypatch.setattr(report.config, "TELEGRAM_TOKEN", "TOKEN", raising=False)
+    monkeypatch.setattr(report.config, "TELEGRAM_CHAT_ID", "42", raising=False)
+    monkeypatch.setattr(report.config, "DISCORD_URL", url+"/discord", raising=False)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_report_senders(standin):
+    import json, requests, report
+    from urllib.parse import parse_qs
+    report.report_telegram("ahoj")
+    report.report_discord("nazdar")
+    (telegram_path, telegram_body), (discord_path, discord_body) = standin.posts
+    assert telegram_path == "/botTOKEN/sendMessage"
+    assert parse_qs(telegram_body)['text'] == ["ahoj"]
+    assert discord_path == "/discord"
+    assert json.loads(discord_body) == {"content": "nazdar"}
+    standin.status = 500
+    with pytest.raises(requests.HTTPError):
+        report.report_discord("down")
+
+# Importing the app takes about half a second here, almost all of it Flask,
+# SQLAlchemy and requests.  Anything talking to the DB or the wiki on import
+# would blow this.
+IMPORT_BUDGET = 2.0
+
+def test_import_budget():
+    import os, sys, subprocess
+    code = """
+import socket, time
+def connect(*args):
+    raise AssertionError("connected on import")
+socket.socket.connect = socket.socket.connect_ex = connect
+started = time.time()
+import rhweb2, rhforum, db
+elapsed = time.time() - started
+assert db.engine is None and rhweb2.wiki is None and rhforum.doku is None
+print(elapsed)
+"""
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert float(output) < IMPORT_BUDGET
+
+def test_wikipage_evicted(client, monkeypatch):
+    import rhweb2
+    from caching import LRUCache
+    assert client.get("/").status_code == 200
+    # too small to keep what load_wikipage() just put in it
+    monkeypatch.setattr(rhweb2, "wiki_cache", LRUCache(0, 300))
+    refreshed = []
+    monkeypatch.setattr(rhweb2, "refresh_wikipage", refreshed.append)
+    assert client.get("/").status_code == 200
+    assert "web2:index" in refreshed
+
+def test_warmup_sidebar_pages():
+    import warmup
+    html = '<a href="/wiki/doku.php?id=web2/o-nas">O nás</a> <a href="/kontakt/#mapa">Kontakt</a>' \
+        ' <a href="/forum/">Fórum</a> <a href="https://example.com/">x</a> <a href="/">RH</a>'
+    assert warmup.sidebar_pages(html) == ["web2:index", "web2:o-nas", "web2:kontakt"]
+
+def test_warmup(client):
+    import warmup, rhweb2
+    messages = []
+    timings = warmup.warmup(log=messages.append)
+    assert list(timings) == ["wiki pages", "templates", "forum queries"]
+    assert not any("compile" in message or "/forum" in message for message in messages)
+    assert "web2:index" in rhweb2.wiki_cache and "web2:sidebar" in rhweb2.wiki_cache
+    # still serving after the pool got emptied
+    assert client.get("/forum/").status_code == 200
+
+def test_wikisync_no_changes(monkeypatch):
+    import xmlrpc.client, time
+    import wikisync, rhweb2
+    from dokuwiki import DokuWikiError
+    class Pages(object):
+        fault = xmlrpc.client.Fault(321, "There are no changes in the specified timeframe")
+        def changes(self, since):
+            raise DokuWikiError(self.fault)
+    class Wiki(object):
+        pages = Pages()
+    monkeypatch.setattr(rhweb2, "get_wiki", lambda: Wiki())
+    saved = []
+    monkeypatch.setattr(wikisync, "save_state", saved.append)
+    assert wikisync.list_revisions(1000) == {}
+    state = {"since": 1000, "pages": {"web2:index": 900}}
+    wikisync.sync(state)
+    assert saved == [state] and state['since'] >= int(time.time()) - 1
+    assert state['pages'] == {"web2:index": 900}
+    # other faults still fail the pass
+    Pages.fault = xmlrpc.client.Fault(1, "nope")
+    with pytest.raises(DokuWikiError):
+        wikisync.list_revisions(1000)
+
+@pytest.mark.parametrize("page,budget", [
+    ("active", 5),
+    ("thread", 15),
+    ("forum", 10),
+])
+def test_query_budget(client, forum_db, query_budget, page, budget):
+    for author_id in (forum_db.admin_id, forum_db.user_id):
+        thread_url, posts = forum_db.make_thread(6, author_id=author_id)
+    login(client)
+    query_budget({"active": "/forum/active", "thread": thread_url, "forum": forum_db.forum_url}[page], budget)
+
+def test_query_stats_header(client, monkeypatch):
+    import querystats
+    monkeypatch.setitem(client.application.config, "QUERY_STATS", True)
+    login(client)
+    header = client.get("/forum/active").headers['X-Query-Stats']
+    assert re.match(r"\d+ queries; [\d.]+ ms; 0 repeated$", header)
+    stats = querystats.QueryStats()
+    for i in range(querystats.REPEAT_THRESHOLD):
+        stats.add("SELECT * FROM posts WHERE id = ?", (i,), 0.001)
+        stats.add("SELECT * FROM fora", (), 0.001)
+    assert stats.repeated() == {"SELECT * FROM posts WHERE id = ?": querystats.REPEAT_THRESHOLD}
+    assert stats.summary() == "10 queries, 10.0 ms"
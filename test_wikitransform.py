@@ -0,0 +1,31 @@
+import os
+import json
+
+import pytest
+
+import wikitransform
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data", "wikipages")
+PAGES = sorted(name[:-5] for name in os.listdir(CORPUS) if name.endswith(".html"))
+
+def read(*path):
+    return open(os.path.join(CORPUS, *path), encoding="utf-8").read()
+
+# The expected files are what the old BeautifulSoup transform produced.
+@pytest.mark.parametrize("name", PAGES)
+def test_transform_golden(name):
+    section = wikitransform.transform_wikipage(read(name+".html"))
+    assert wikitransform.to_html(section) == read("expected", name+".html")
+
+@pytest.mark.parametrize("name", PAGES)
+def test_title_and_description_golden(name):
+    expected = json.loads(read("expected", "meta.json"))[name]
+    section = wikitransform.transform_wikipage(read(name+".html"))
+    has_heading, title = wikitransform.page_title(section)
+    assert has_heading == expected['has_heading']
+    assert title == expected['title']
+    assert wikitransform.page_description(section) == expected['description']
+
+def test_image_without_link_gets_wrapped():
+    section = wikitransform.transform_wikipage('<p>a <img src="/wiki/lib/exe/fetch.php?media=x.png" class="mediacenter" width="10" title="Hi"> b</p>')
+    assert wikitransform.to_html(section) == '<section><p>a <div class="mediacenter  mediawrap" style="width: 10px;"><img src="https://retroherna.org/wiki/lib/exe/fetch.php?media=x.png" title="Hi" width="10"/><div class="mediatitle" style="max-width: 10px;">Hi</div></div> b</p></section>'
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+"""
+Does what the first requests to a fresh worker would otherwise pay for:
+fetches the wiki pages the sidebar links to, compiles every template,
+configures the mappers and runs the forum index and active-thread queries.
+
+    ./warmup.py       # e.g. right after a deploy; says how long each part took
+
+With a pre-fork server, warm up the master once and let the workers share
+it copy-on-write, e.g. in gunicorn.conf.py (with preload_app = True):
+
+    def on_starting(server):
+        import warmup
+        warmup.preload()
+"""
+import re
+import time
+
+from sqlalchemy.orm import configure_mappers
+
+import db
+import rhweb2
+
+FORUM_URLS = ("/forum/", "/forum/active")
+
+href_re = re.compile(r"""href=["']([^"']*)["']""")
+
+def sidebar_pages(html):
+    """The web2: pages the sidebar links to, index first."""
+    pages = ["web2:index"]
+    for href in href_re.findall(html):
+        href = href.split("#")[0]
+        match = re.search(r"id=(web2[:/][^&]+)", href)
+        if match:
+            path = match.group(1)[len("web2:"):]
+        elif href.startswith("/") and not href.startswith(("//", "/forum", "/static", "/wiki")):
+            path = href.strip("/") or "index"
+        else:
+            continue
+        name = "web2:"+path.replace("/", ":")
+        if name not in pages:
+            pages.append(name)
+    return pages
+
+def fetch_pages(app, client, log):
+    if not rhweb2.WIKI_SYNC:
+        # Fetched up front, or the page views below would start background
+        # refreshes of stale cache/ files, which a fork doesn't carry over.
+        try:
+            rhweb2.fetch_wikipage("web2:sidebar")
+        except Exception as ex:
+            log("web2:sidebar fetch failed: {}: {}".format(type(ex).__name__, ex))
+    client.get("/")
+    for name in sidebar_pages(rhweb2.sidebar.html):
+        if not rhweb2.WIKI_SYNC:
+            try:
+                rhweb2.fetch_wikipage(name)
+            except Exception as ex:
+                log("{} fetch failed: {}: {}".format(name, type(ex).__name__, ex))
+        path = name[len("web2:"):].replace(":", "/")
+        status = client.get("/" if path == "index" else "/"+path).status_code
+        if status != 200:
+            log("{} answered {}".format(name, status))
+    return len(rhweb2.wiki_cache)
+
+def compile_templates(app, client, log):
+    count = 0
+    # the top level ones besides _base and _macros are leftovers nothing renders
+    names = [name for name in app.jinja_env.list_templates(extensions=["html"])
+        if name.startswith(("forum/", "_"))]
+    for name in names:
+        try:
+            app.jinja_env.get_template(name)
+            count += 1
+        except Exception as ex:
+            log("{} doesn't compile: {}: {}".format(name, type(ex).__name__, ex))
+    return count
+
+def forum_queries(app, client, log):
+    configure_mappers()
+    for url in FORUM_URLS:
+        status = client.get(url).status_code
+        if status != 200:
+            log("{} answered {}".format(url, status))
+    return len(FORUM_URLS)
+
+def warmup(app=None, log=print):
+    """Warms up this process.  Returns {step: seconds}."""
+    app = app or rhweb2.app
+    client = app.test_client()
+    timings = {}
+    for step, run in (("wiki pages", fetch_pages), ("templates", compile_templates), ("forum queries", forum_queries)):
+        started = time.time()
+        count = run(app, client, log)
+        timings[step] = time.time() - started
+        log("{}: {} in {:.2f}s".format(step, count, timings[step]))
+    # Connections must not be shared with forked workers; they open their own.
+    db.session.remove()
+    db.get_engine().dispose()
+    return timings
+
+def preload(app=None):
+    """For a pre-fork server's master process.  Never keeps it from starting."""
+    try:
+        warmup(app)
+    except Exception as ex:
+        print("warmup failed: {}: {}".format(type(ex).__name__, ex))
+
+if __name__ == "__main__":
+    timings = warmup()
+    print("warmed up in {:.2f}s".format(sum(timings.values())))
@@ -0,0 +1,99 @@
+# encoding: utf-8
+"""
+A DokuWiki client for use by the web workers.  Compared to a bare
+dokuwiki.DokuWiki it
+
+ - talks XML-RPC over a pooled requests Session, so connections are kept
+   alive between calls instead of doing a new TCP+TLS handshake every time,
+ - logs in on first use rather than on import,
+ - has a timeout on every call and retries the ones that failed on the way
+   (connection errors, timeouts, 5xx) with exponential backoff,
+ - can make several independent calls at once, see parallel().
+"""
+import time
+import threading
+import xmlrpc.client
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import dokuwiki
+
+class PooledTransport(xmlrpc.client.Transport):
+    """An xmlrpc transport going through a requests Session."""
+    def __init__(self, https=True, pool_size=10, timeout=10):
+        super().__init__()
+        self.scheme = "https" if https else "http"
+        self.timeout = timeout
+        self.local = threading.local()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, host, handler, request_body, verbose=False):
+        host, extra_headers, x509 = self.get_host_info(host)
+        headers = dict(extra_headers or ())
+        headers['Content-Type'] = "text/xml"
+        headers['User-Agent'] = self.user_agent
+        response = self.session.post("{}://{}{}".format(self.scheme, host, handler),
+            data=request_body, headers=headers, timeout=getattr(self.local, 'timeout', None) or self.timeout)
+        if response.status_code != 200:
+            raise xmlrpc.client.ProtocolError(host+handler, response.status_code,
+                response.reason, dict(response.headers))
+        parser, unmarshaller = self.getparser()
+        parser.feed(response.content)
+        parser.close()
+        return unmarshaller.close()
+
+def transient(ex):
+    if isinstance(ex, requests.RequestException):
+        return True
+    return isinstance(ex, xmlrpc.client.ProtocolError) and ex.errcode >= 500
+
+class WikiClient(object):
+    """Drop-in for dokuwiki.DokuWiki as far as we use it: send() and pages."""
+    executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="wiki")
+
+    def __init__(self, url, user, password, timeout=10, retries=2, backoff=0.5, pool_size=10):
+        self.url = url
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.transport = PooledTransport(https=url.startswith("https:"), pool_size=pool_size, timeout=timeout)
+        self.wiki = None
+        self.lock = threading.Lock()
+        # dokuwiki's own wrapper of the wiki.* page calls, running through our send()
+        self.pages = dokuwiki._Pages(self)
+
+    def connect(self):
+        with self.lock:
+            if self.wiki is None:
+                self.wiki = self.retry(lambda: dokuwiki.DokuWiki(self.url, self.user, self.password, transport=self.transport))
+            return self.wiki
+
+    def retry(self, call):
+        for attempt in range(self.retries + 1):
+            try:
+                return call()
+            except Exception as ex:
+                if attempt == self.retries or not transient(ex):
+                    raise
+            time.sleep(self.backoff * 2**attempt)
+
+    def send(self, command, *args, timeout=None):
+        """Like DokuWiki.send, but with retries and an optional per-call timeout."""
+        wiki = self.wiki or self.connect()
+        self.transport.local.timeout = timeout
+        try:
+            return self.retry(lambda: wiki.send(command, *args))
+        finally:
+            self.transport.local.timeout = None
+
+    def parallel(self, *calls, timeout=None):
+        """Makes the (command, args...) calls concurrently and returns their
+        results in order.  Raises the first call's exception, if any failed."""
+        self.wiki or self.connect()
+        futures = [self.executor.submit(self.send, call[0], *call[1:], timeout=timeout) for call in calls]
+        return [future.result() for future in futures]
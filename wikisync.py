@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+"""
+Keeps cache/ in sync with the web2: namespace of the wiki, so that the web
+workers don't have to talk to DokuWiki at all (set WIKI_SYNC = True in
+config.py).  Only pages whose revision moved since the last pass get fetched.
+
+    ./wikisync.py           # poll every WIKI_SYNC_INTERVAL seconds
+    ./wikisync.py --once    # a single pass, e.g. before starting the workers
+"""
+import os
+import sys
+import json
+import time
+import xmlrpc.client
+
+from dokuwiki import DokuWikiError
+
+import rhweb2
+from caching import write_atomic
+
+NAMESPACE = "web2"
+STATE_PATH = rhweb2.app_dir+"/cache/.wikisync.json"
+INTERVAL = rhweb2.config.get("WIKI_SYNC_INTERVAL", 60)
+
+# DokuWiki's answer to wiki.getRecentChanges when nothing changed
+NO_CHANGES = 321
+
+def load_state():
+    try:
+        return json.load(open(STATE_PATH))
+    except (EnvironmentError, ValueError):
+        return {"since": 0, "pages": {}}
+
+def save_state(state):
+    write_atomic(STATE_PATH, json.dumps(state))
+
+def list_revisions(since):
+    """Returns {page name: revision timestamp} for web2: pages changed since
+    `since`, or for all of them on the first run."""
+    if not since:
+        pages = rhweb2.get_wiki().pages.list(NAMESPACE)
+        return {page['id']: page['mtime'] for page in pages}
+    try:
+        changes = rhweb2.get_wiki().pages.changes(since) or []
+    except DokuWikiError as ex:
+        # "There are no changes in the specified timeframe" comes as a fault
+        fault = ex.args[0] if ex.args else None
+        if not isinstance(fault, xmlrpc.client.Fault) or fault.faultCode != NO_CHANGES:
+            raise
+        changes = []
+    return {change['name']: change['version'] for change in changes
+        if change['name'].startswith(NAMESPACE+":")}
+
+def sync(state):
+    started = int(time.time())
+    revisions = list_revisions(state['since'])
+    for name, revision in sorted(revisions.items()):
+        if state['pages'].get(name) == revision:
+            continue
+        page = rhweb2.fetch_wikipage(name)
+        if not page and os.path.exists(rhweb2.wikipage_path(name)):
+            # the page got deleted
+            os.remove(rhweb2.wikipage_path(name))
+        state['pages'][name] = revision
+        print("{} synced (revision {})".format(name, revision))
+
+    if revisions:
+        state['since'] = max([state['since']] + list(revisions.values()))
+    elif state['since']:
+        # nothing changed up to when we asked, so don't ask about that again
+        state['since'] = max(state['since'], started)
+    save_state(state)
+
+if __name__ == "__main__":
+    once = "--once" in sys.argv[1:]
+    state = load_state()
+    while True:
+        try:
+            sync(state)
+        except Exception as ex:
+            print("sync failed: {}: {}".format(type(ex).__name__, ex))
+            if once: exit(1)
+        if once: break
+        time.sleep(INTERVAL)
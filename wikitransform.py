@@ -0,0 +1,217 @@
+# encoding: utf-8
+"""
+Turns DokuWiki's page HTML into what we serve: internal links pointed at this
+site, images wrapped in mediawrap divs with mediatitle captions.
+
+This used to be a BeautifulSoup pass.  It's plain lxml now, but the output is
+kept byte for byte what BeautifulSoup 4.6 produced (see to_html()), so that
+cached pages and test_data/wikipages/expected stay valid.
+"""
+import re
+
+from lxml import etree
+
+# What BeautifulSoup's HTML tree builder considers void, whitespace-preserving,
+# raw text and multi-valued attributes.
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen',
+    'link', 'menuitem', 'meta', 'param', 'source', 'track', 'wbr', 'spacer', 'frame'}
+PRESERVE_WHITESPACE_TAGS = {'pre', 'textarea'}
+RAW_TEXT_TAGS = {'script', 'style'}
+LIST_ATTRIBUTES = {'class', 'accesskey', 'dropzone'}
+TAG_LIST_ATTRIBUTES = {
+    'a': {'rel', 'rev'},
+    'link': {'rel', 'rev'},
+    'td': {'headers'},
+    'th': {'headers'},
+    'form': {'accept-charset'},
+    'object': {'archive'},
+    'area': {'rel'},
+    'icon': {'sizes'},
+    'iframe': {'sandbox'},
+    'output': {'for'},
+}
+
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+whitespace_re = re.compile(r"\s+")
+
+def escape(text):
+    if "&" in text: text = text.replace("&", "&amp;")
+    if "<" in text: text = text.replace("<", "&lt;")
+    if ">" in text: text = text.replace(">", "&gt;")
+    return text
+
+def collapse_whitespace(text):
+    # Whitespace-only strings outside of <pre> get squashed to one character.
+    if not text or text.strip(ASCII_SPACES):
+        return text
+    return '\n' if '\n' in text else ' '
+
+def normalize(root):
+    """Brings a freshly parsed tree to the shape BeautifulSoup keeps: blank
+    strings collapsed and multi-valued attributes single-spaced."""
+    preserved = set()
+    for el in root.iter('pre', 'textarea'):
+        preserved.update(el.iter())
+    
+    for el in root.iter():
+        tag = el.tag
+        if tag is not etree.Comment and isinstance(tag, str) and len(el.attrib):
+            for name, value in el.items():
+                if name in LIST_ATTRIBUTES or name in TAG_LIST_ATTRIBUTES.get(tag, ()):
+                    el.set(name, whitespace_re.sub(" ", value))
+        text = el.text
+        if text and not text.strip(ASCII_SPACES) and el not in preserved:
+            el.text = collapse_whitespace(text)
+        tail = el.tail
+        if tail and not tail.strip(ASCII_SPACES) and (not preserved or el.getparent() not in preserved):
+            el.tail = collapse_whitespace(tail)
+
+def bare_attributes(root):
+    # e.g. `checked`, which the tree parser fills in as checked="checked"
+    return any(value == name for el in root.iter() for name, value in el.items())
+
+def parse(page):
+    parser = etree.HTMLParser()
+    parser.feed(page)
+    root = parser.close()
+    if root is None or root.find('body') is None or bare_attributes(root):
+        # The tree parser doesn't see these pages quite like BeautifulSoup
+        # did, but lxml going through a target does.  It's slower, though.
+        parser = etree.HTMLParser(target=etree.TreeBuilder())
+        parser.feed(page)
+        root = parser.close()
+    normalize(root)
+    return root
+
+def transform_wikipage(page):
+    """Returns the transformed page as a <section> element."""
+    page = page.replace("~CLEAR~", '<div style="clear: both;"></div>')
+    page = page.replace("retroherna.cz", "retroherna.org")
+    root = parse(page)
+
+    for a in root.iter('a'):
+        href = a.get('href')
+        if href and "/wiki/doku.php" in href:
+            a.set('href', href.replace("/wiki/doku.php?id=web:", "/").replace(':', '/'))
+
+    for img in list(root.iter('img')):
+        src = img.get('src', "")
+        if not src.startswith("http"):
+            img.set('src', src.replace("/wiki/lib/exe/fetch.php", "https://retroherna.org/wiki/lib/exe/fetch.php"))
+        title = img.get('title')
+
+        parent = img.getparent()
+        if parent.tag == "a" and parent.get('href', "").startswith("/wiki"):
+            parent.tag = "div"
+            del parent.attrib['href']
+        else:
+            wrapper = etree.Element("div")
+            wrapper.tail, img.tail = img.tail, None
+            img.addprevious(wrapper)
+            wrapper.append(img)
+            parent = wrapper
+        classes = img.get('class').split(" ") if img.get('class') is not None else []
+        parent.set('class', " ".join(classes + [" mediawrap"]))
+        if 'mediacenter' in classes and img.get('width'):
+            # life is too short
+            parent.set('style', 'width: {}px;'.format(img.get('width')))
+        img.attrib.pop('class', None)
+
+        # XXX yes this is necessary, thanks dokuwiki
+        if title and not any(title.endswith(t) for t in ("png", "jpg", "jpeg", "gif")):
+            caption = etree.SubElement(parent, "div")
+            caption.set('class', "mediatitle")
+            if img.get('width'):
+                caption.set('style', "max-width: {}px;".format(img.get('width')))
+            caption.text = title
+
+    section = root.find('body')
+    section.tag = "section"
+    section.tail = None
+    return section
+
+def quote_attribute(value):
+    value = escape(value)
+    if '"' not in value:
+        return '"' + value + '"'
+    if "'" not in value:
+        return "'" + value + "'"
+    return '"' + value.replace('"', "&quot;") + '"'
+
+def to_html(el):
+    """Serializes el like BeautifulSoup 4.6's str(tag) does: sorted
+    attributes, <br/>-style void tags, only &, < and > escaped."""
+    out = []
+    append = out.append
+    Comment, PI = etree.Comment, etree.PI
+
+    def write(el):
+        tag = el.tag
+        if tag is Comment:
+            append("<!--" + (el.text or "") + "-->")
+            return
+        if tag is PI:
+            append("<?" + el.target + " " + (el.text or "") + ">")
+            return
+        append("<" + tag)
+        if len(el.attrib):
+            for name, value in sorted(el.items()):
+                append(" " + name + "=" + quote_attribute(value))
+        if tag in VOID_TAGS and not el.text and not len(el):
+            append("/>")
+            return
+        append(">")
+        raw = tag in RAW_TEXT_TAGS
+        if el.text:
+            append(el.text if raw else escape(el.text))
+        for child in el:
+            write(child)
+            if child.tail:
+                append(child.tail if raw else escape(child.tail))
+        append("</" + tag + ">")
+
+    write(el)
+    return "".join(out)
+
+def string(el):
+    """BeautifulSoup's tag.string: the only string inside el, or None."""
+    children = list(el)
+    if len(children) + bool(el.text) + sum(1 for child in children if child.tail) != 1:
+        return None
+    if el.text:
+        return el.text
+    child = children[0]
+    if child.tail:
+        return child.tail
+    if child.tag is etree.Comment or child.tag is etree.PI:
+        return child.text
+    return string(child)
+
+def get_text(el):
+    """BeautifulSoup's tag.get_text(): all text inside el, minus comments."""
+    out = []
+    def walk(el):
+        if el.text and isinstance(el.tag, str):
+            out.append(el.text)
+        for child in el:
+            walk(child)
+            if child.tail:
+                out.append(child.tail)
+    walk(el)
+    return "".join(out)
+
+def page_title(section):
+    """Returns (whether the page has a heading, the heading's text or None)."""
+    heading = section.find('.//h1')
+    if heading is None: heading = section.find('.//h2')
+    if heading is None: heading = section.find('.//h3')
+    if heading is None:
+        return False, None
+    return True, string(heading)
+
+def page_description(section):
+    for p in section.iter('p'):
+        text = get_text(p).strip()
+        if text and len(text) > 30:
+            return text
+    return ""